@@ -5,7 +5,7 @@ import PIL
 from jicbioimage.core.util.color import pretty_color_from_identifier
 from jicbioimage.illustrate import AnnotatedImage
 
-from utils import marker_cell_identifier
+from utils import marker_cell_assignment
 
 
 def annotate_segmentation(cells, fh):
@@ -17,9 +17,11 @@ def annotate_markers(markers, cells, fh):
     """Write out marker image."""
     ydim, xdim = markers.shape
     ann = AnnotatedImage.blank_canvas(width=xdim, height=ydim)
+    assignment = marker_cell_assignment(markers, cells)
+    cell_ids = dict(zip(assignment.marker_ids, assignment.cell_ids))
     for i in markers.identifiers:
         m_region = markers.region_by_identifier(i)
-        cell_id = marker_cell_identifier(m_region, cells)
+        cell_id = cell_ids[i]
         color = pretty_color_from_identifier(cell_id)
         ann.mask_region(m_region, color)
     fh.write(ann.png())
@@ -0,0 +1,455 @@
+"""Module for persisting the tensor editing history.
+
+Rather than rewriting the whole audit log after every edit, each edit is
+appended to a journal as it is made, along with small markers recording
+undo and redo. Compacting the journal works out which edits are still in
+effect and appends them to the audit log.
+
+Snapshots of all the tensors, tagged with the length of the audit log they
+include, save replaying the whole audit log when the tensors are loaded.
+"""
+
+import os
+import os.path
+import re
+import json
+import shutil
+import hashlib
+import logging
+import tempfile
+
+from tensor import TensorManager
+from tensorfile import RAW_TENSORS_BINARY_FNAME
+
+RAW_TENSORS_FNAME = "raw_tensors.txt"
+AUDIT_LOG_FNAME = "audit.log"
+JOURNAL_FNAME = "audit.journal"
+SNAPSHOT_FNAME_FORMAT = "snapshot_{:d}.txt"
+SNAPSHOT_VERSION = 1
+
+UNDO = json.dumps({"journal": "undo"})
+REDO = json.dumps({"journal": "redo"})
+
+
+class AuditJournal(object):
+    """Append-only journal of tensor edits.
+
+    fsync_every: number of writes after which the journal is synced to disk;
+                 1 syncs every edit, larger numbers group the syncs and 0
+                 leaves it to the operating system."""
+
+    def __init__(self, fpath, fsync_every=1):
+        self.fpath = fpath
+        self.fsync_every = fsync_every
+        self._fh = open(fpath, "a")
+        self._unsynced = 0
+
+    def _write(self, line):
+        self._fh.write(line + "\n")
+        self._fh.flush()
+        self._unsynced += 1
+        if self.fsync_every and self._unsynced >= self.fsync_every:
+            self.sync()
+
+    def append(self, entry):
+        """Record an edit, given as its audit log entry."""
+        if "\n" in entry:
+            # The lines of a batch edit are undone and redone together.
+            entry = json.dumps({"journal": "batch",
+                                "entries": entry.split("\n")})
+        self._write(entry)
+
+    def amend(self, entry):
+        """Record an edit replacing the last one, given as its audit log
+        entry."""
+        self._write(json.dumps({"journal": "amend", "entry": entry}))
+
+    def undo(self):
+        """Record that the last edit in effect has been undone."""
+        self._write(UNDO)
+
+    def redo(self):
+        """Record that the last edit undone has been redone."""
+        self._write(REDO)
+
+    def sync(self):
+        """Force the journal to disk."""
+        os.fsync(self._fh.fileno())
+        self._unsynced = 0
+
+    def close(self):
+        """Sync and close the journal."""
+        if self._fh.closed:
+            return
+        self.sync()
+        self._fh.close()
+
+
+def effective_entries(lines):
+    """Return list of the entries of a journal that are still in effect."""
+    entries = []
+    offset = 0
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            d = json.loads(line)
+        except ValueError:
+            # A crash can leave a partly written last line.
+            logging.warning("Skipping corrupt journal line: {}".format(line))
+            continue
+        marker = d.get("journal")
+        if marker == "undo":
+            if len(entries) + offset > 0:
+                offset -= 1
+        elif marker == "redo":
+            if offset < 0:
+                offset += 1
+        elif marker == "amend":
+            if offset != 0:
+                entries = entries[:offset]
+                offset = 0
+            if entries:
+                entries[-1] = d["entry"]
+            else:
+                entries.append(d["entry"])
+        else:
+            # Clip the undone entries when a new edit is made.
+            if offset != 0:
+                entries = entries[:offset]
+                offset = 0
+            if marker == "batch":
+                line = "\n".join(d["entries"])
+            entries.append(line)
+    return entries[:len(entries) + offset]
+
+
+def write_atomically(fpath, lines):
+    """Write lines to fpath, replacing any previous file in one step."""
+    directory = os.path.dirname(os.path.abspath(fpath))
+    fd, tmp_fpath = tempfile.mkstemp(suffix=".tmp", dir=directory)
+    with os.fdopen(fd, "w") as fh:
+        for line in lines:
+            fh.write("{}\n".format(line))
+        fh.flush()
+        os.fsync(fh.fileno())
+    os.rename(tmp_fpath, fpath)
+
+
+def compact(directory):
+    """Append the entries in effect in the journal to the audit log and
+    remove the journal."""
+    journal_fpath = os.path.join(directory, JOURNAL_FNAME)
+    audit_log_fpath = os.path.join(directory, AUDIT_LOG_FNAME)
+    if not os.path.isfile(journal_fpath):
+        return
+    lines = []
+    if os.path.isfile(audit_log_fpath):
+        with open(audit_log_fpath) as fh:
+            lines = [line.strip() for line in fh if line.strip()]
+    with open(journal_fpath) as fh:
+        entries = effective_entries(fh)
+    if entries:
+        write_atomically(audit_log_fpath, lines + entries)
+    os.unlink(journal_fpath)
+    logging.debug("Compacted {} journal entries".format(len(entries)))
+
+
+def raw_tensors_fpath(directory):
+    """Return path of the raw tensors file in directory, preferring the
+    binary format unless the JSON lines file is newer."""
+    binary_fpath = os.path.join(directory, RAW_TENSORS_BINARY_FNAME)
+    fpath = os.path.join(directory, RAW_TENSORS_FNAME)
+    if not os.path.isfile(binary_fpath):
+        return fpath
+    if (os.path.isfile(fpath)
+            and os.path.getmtime(fpath) > os.path.getmtime(binary_fpath)):
+        logging.warning("Ignoring {}, older than {}".format(binary_fpath,
+                                                            fpath))
+        return fpath
+    return binary_fpath
+
+
+def _md5(fpath, num_bytes=None):
+    """Return md5 hex digest of the first num_bytes (default all) of a file,
+    or None if the file is shorter than that."""
+    md5 = hashlib.md5()
+    with open(fpath, "rb") as fh:
+        while num_bytes is None or num_bytes > 0:
+            size = 1024**2 if num_bytes is None else min(num_bytes, 1024**2)
+            chunk = fh.read(size)
+            if not chunk:
+                break
+            md5.update(chunk)
+            if num_bytes is not None:
+                num_bytes -= len(chunk)
+    if num_bytes:
+        return None
+    return md5.hexdigest()
+
+
+def snapshot_fpaths(directory):
+    """Return list of snapshot file paths, latest first."""
+    pattern = re.compile(r"^snapshot_(\d+)\.txt$")
+    snapshots = []
+    for fname in os.listdir(directory):
+        match = pattern.match(fname)
+        if match:
+            snapshots.append((int(match.group(1)),
+                              os.path.join(directory, fname)))
+    return [fpath for _, fpath in sorted(snapshots, reverse=True)]
+
+
+def write_snapshot(tensor_manager, directory, keep=2):
+    """Write snapshot of the tensors including the current audit log.
+
+    Only the latest keep snapshots are kept."""
+    audit_log_fpath = os.path.join(directory, AUDIT_LOG_FNAME)
+    offset = 0
+    audit_log_md5 = hashlib.md5().hexdigest()
+    if os.path.isfile(audit_log_fpath):
+        offset = os.path.getsize(audit_log_fpath)
+        audit_log_md5 = _md5(audit_log_fpath, offset)
+    header = dict(snapshot_version=SNAPSHOT_VERSION,
+                  audit_log_offset=offset,
+                  audit_log_md5=audit_log_md5,
+                  raw_tensors_md5=_md5(raw_tensors_fpath(directory)),
+                  num_tensors=len(tensor_manager))
+    lines = [json.dumps(header)]
+    for tensor_id in tensor_manager.identifiers:
+        lines.append(tensor_manager[tensor_id].json)
+    fpath = os.path.join(directory, SNAPSHOT_FNAME_FORMAT.format(offset))
+    write_atomically(fpath, lines)
+    logging.debug("Wrote snapshot {}".format(fpath))
+
+    for old_fpath in snapshot_fpaths(directory)[keep:]:
+        os.unlink(old_fpath)
+
+
+def read_snapshot(fpath, directory):
+    """Return (audit log offset, tensor json lines) from a snapshot, or None
+    if it does not match the raw tensors and audit log in directory."""
+    with open(fpath) as fh:
+        try:
+            header = json.loads(fh.readline())
+        except ValueError:
+            return None
+        lines = fh.readlines()
+    if header.get("snapshot_version") != SNAPSHOT_VERSION:
+        return None
+    if len(lines) != header["num_tensors"]:
+        return None
+    if _md5(raw_tensors_fpath(directory)) != header["raw_tensors_md5"]:
+        return None
+    offset = header["audit_log_offset"]
+    if offset > 0:
+        audit_log_fpath = os.path.join(directory, AUDIT_LOG_FNAME)
+        if not os.path.isfile(audit_log_fpath):
+            return None
+        if _md5(audit_log_fpath, offset) != header["audit_log_md5"]:
+            return None
+    return offset, lines
+
+
+def load_tensor_manager(directory, tensor_manager=None, snapshot_every=1000):
+    """Return TensorManager with the raw tensors and audit log in directory
+    applied.
+
+    The latest valid snapshot is loaded and only the audit log after it is
+    replayed. A new snapshot is written if snapshot_every or more lines had
+    to be replayed (0 never writes one)."""
+    if tensor_manager is None:
+        tensor_manager = TensorManager()
+    compact(directory)
+
+    offset = 0
+    for fpath in snapshot_fpaths(directory):
+        snapshot = read_snapshot(fpath, directory)
+        if snapshot is not None:
+            offset, lines = snapshot
+            tensor_manager.read_raw_tensors(lines)
+            logging.debug("Loaded snapshot {}".format(fpath))
+            break
+    else:
+        tensor_manager.read_tensor_file(raw_tensors_fpath(directory))
+
+    num_replayed = 0
+    audit_log_fpath = os.path.join(directory, AUDIT_LOG_FNAME)
+    if os.path.isfile(audit_log_fpath):
+        with open(audit_log_fpath, "rb") as fh:
+            fh.seek(offset)
+            for line in fh:
+                tensor_manager.apply_json(line.decode("utf-8"))
+                num_replayed += 1
+    logging.debug("Replayed {} audit log lines".format(num_replayed))
+
+    if snapshot_every and num_replayed >= snapshot_every:
+        write_snapshot(tensor_manager, directory)
+    return tensor_manager
+
+
+def test_snapshot_replay():
+
+    directory = tempfile.mkdtemp()
+
+    def full_replay():
+        tensor_manager = TensorManager()
+        with open(os.path.join(directory, RAW_TENSORS_FNAME)) as fh:
+            tensor_manager.read_raw_tensors(fh)
+        with open(os.path.join(directory, AUDIT_LOG_FNAME)) as fh:
+            tensor_manager.apply_audit_log(fh)
+        return tensor_manager
+
+    def edit_session(num_edits):
+        tensor_manager = load_tensor_manager(directory, snapshot_every=5)
+        tensor_manager.journal = AuditJournal(
+            os.path.join(directory, JOURNAL_FNAME))
+        for i in range(num_edits):
+            tensor_id = tensor_manager.identifiers[i % 3]
+            tensor_manager.update_marker(tensor_id, (i, i + 1))
+            tensor_manager.add_tensor((i, 2), (3, i))
+            tensor_manager.inactivate_tensor(tensor_id)
+            tensor_manager.undo()
+        tensor_manager.journal.close()
+        return tensor_manager
+
+    tensor_manager = TensorManager()
+    for i in range(3):
+        tensor_manager.create_tensor(i, (i, 0), (0, i))
+    with open(os.path.join(directory, RAW_TENSORS_FNAME), "w") as fh:
+        tensor_manager.write_raw_tensors(fh)
+
+    # Without any audit log or snapshot.
+    assert load_tensor_manager(directory) == tensor_manager
+
+    # A snapshot is only written once enough lines have been replayed.
+    edit_session(1)
+    assert load_tensor_manager(directory, snapshot_every=5) == full_replay()
+    assert len(snapshot_fpaths(directory)) == 0
+    edit_session(4)
+    assert load_tensor_manager(directory, snapshot_every=5) == full_replay()
+    assert len(snapshot_fpaths(directory)) == 1
+
+    # Load from the snapshot replaying only the tail of the audit log.
+    last_session = edit_session(2)
+    assert load_tensor_manager(directory, snapshot_every=0) == last_session
+    assert load_tensor_manager(directory, snapshot_every=0) == full_replay()
+
+    # Invalid snapshots are skipped.
+    with open(snapshot_fpaths(directory)[0], "a") as fh:
+        fh.write("{}\n".format(tensor_manager[0].json))
+    assert load_tensor_manager(directory, snapshot_every=0) == full_replay()
+    with open(os.path.join(directory, AUDIT_LOG_FNAME), "w") as fh:
+        fh.write("")
+    assert load_tensor_manager(directory, snapshot_every=0) == tensor_manager
+
+    shutil.rmtree(directory)
+
+
+
+def test_journal_compaction():
+
+    directory = tempfile.mkdtemp()
+    journal_fpath = os.path.join(directory, JOURNAL_FNAME)
+
+    def full_replay():
+        tensor_manager = TensorManager()
+        with open(os.path.join(directory, RAW_TENSORS_FNAME)) as fh:
+            tensor_manager.read_raw_tensors(fh)
+        with open(os.path.join(directory, AUDIT_LOG_FNAME)) as fh:
+            tensor_manager.apply_audit_log(fh)
+        return tensor_manager
+
+    def audit_log_length():
+        with open(os.path.join(directory, AUDIT_LOG_FNAME)) as fh:
+            return len(fh.readlines())
+
+    def edit_session(edit, **kwargs):
+        tensor_manager = load_tensor_manager(
+            directory, TensorManager(**kwargs), snapshot_every=0)
+        tensor_manager.journal = AuditJournal(journal_fpath)
+        edit(tensor_manager)
+        tensor_manager.journal.close()
+        compact(directory)
+        assert not os.path.exists(journal_fpath)
+        return tensor_manager
+
+    tensor_manager = TensorManager()
+    for i in range(5):
+        tensor_manager.create_tensor(i, (i, 0), (0, i))
+    with open(os.path.join(directory, RAW_TENSORS_FNAME), "w") as fh:
+        tensor_manager.write_raw_tensors(fh)
+
+    # Test undo and redo, a new edit clipping the undone ones, and more
+    # undos than there are edits.
+    def edit(tensor_manager):
+        tensor_manager.update_marker(0, (1, 1))
+        tensor_manager.add_tensor((2, 2), (3, 3))
+        tensor_manager.inactivate_tensor(1)
+        tensor_manager.undo()
+        tensor_manager.undo()
+        tensor_manager.redo()
+        tensor_manager.update_centroid(2, (4, 4))
+        for _ in range(4):
+            tensor_manager.undo()
+        tensor_manager.redo()
+    assert edit_session(edit) == full_replay()
+    assert audit_log_length() == 1
+
+    # Test that a partly written last line is skipped.
+    def edit(tensor_manager):
+        tensor_manager.update_marker(3, (6, 6))
+        tensor_manager.journal.append('{"tensor_id": 3, "mar')
+    assert edit_session(edit) == full_replay()
+    assert audit_log_length() == 2
+
+    # Test that coalesced moves amend the journal, and that commands dropped
+    # from the undo history are still compacted.
+    def edit(tensor_manager):
+        for i in range(5):
+            tensor_manager.update_marker(3, (i, i + 1))
+        assert len(tensor_manager.commands) == 1
+        tensor_manager.undo()
+        tensor_manager.redo()
+        tensor_manager.update_marker(3, (7, 7))
+        tensor_manager.update_centroid(3, (8, 8))
+        tensor_manager.undo()
+        tensor_manager.update_centroid(3, (9, 9))
+        tensor_manager.update_centroid(3, (9, 10))
+        for tensor_id in range(1, 4):
+            tensor_manager.inactivate_tensor(tensor_id)
+        assert len(tensor_manager.commands) == 2
+    edited = edit_session(edit, coalesce_window=60, max_history=2)
+    assert edited == full_replay()
+    assert edited[3].marker == [7, 7] and edited[3].centroid == [9, 10]
+    assert audit_log_length() == 8
+    with open(os.path.join(directory, AUDIT_LOG_FNAME)) as fh:
+        session_lines = fh.read().splitlines()[2:]
+    assert [cmd.audit_log for cmd in edited.audit_log] == session_lines
+
+    # Test that batch edits are undone and redone as a whole, and that
+    # rejected batches leave no trace.
+    def edit(tensor_manager):
+        tensor_manager.apply_batch([dict(tensor_id=0, marker=(5, 5)),
+                                    dict(tensor_id=1, active=True)])
+        tensor_manager.inactivate_many(tensor_manager.identifiers)
+        tensor_manager.undo()
+        tensor_manager.undo()
+        tensor_manager.redo()
+        try:
+            tensor_manager.apply_batch([dict(tensor_id=2, marker=(1,))])
+        except ValueError:
+            pass
+    edited = edit_session(edit)
+    assert edited == full_replay()
+    assert edited[0].marker == [5, 5] and edited[1].active is True
+    assert audit_log_length() == 10
+
+    shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.DEBUG)
+    test_snapshot_replay()
+    test_journal_compaction()
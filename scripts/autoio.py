@@ -0,0 +1,153 @@
+"""Context-local auto-writing and auto-naming of images.
+
+The jicbioimage transformations decide whether to write out each image,
+and where, using the process-global AutoWrite.on and AutoName settings.
+This module replaces them with proxies that read the settings of the
+current context, so that analyses running concurrently in threads (or
+asyncio tasks) of one process do not interfere with each other.
+
+>>> with auto_io(directory="output/genotype1", on=False):
+...     analyse(...)
+
+Outside of any auto_io context the proxies read and write the original
+global settings, so existing code behaves as before. New threads start
+outside of any context.
+"""
+
+import os.path
+import threading
+import contextlib
+
+import jicbioimage.core.io
+import jicbioimage.core.transform
+
+try:
+    import contextvars
+except ImportError:
+    contextvars = None
+
+_GlobalAutoWrite = jicbioimage.core.io.AutoWrite
+_GlobalAutoName = jicbioimage.core.io.AutoName
+
+if contextvars is not None:
+    _settings_var = contextvars.ContextVar("auto_io_settings", default=None)
+
+    def _current_settings():
+        return _settings_var.get()
+
+    def _set_settings(settings):
+        _settings_var.set(settings)
+else:
+    _local = threading.local()
+
+    def _current_settings():
+        return getattr(_local, "settings", None)
+
+    def _set_settings(settings):
+        _local.settings = settings
+
+
+class AutoIOSettings(object):
+    """Auto-writing and auto-naming settings of one context."""
+
+    def __init__(self, on, directory, prefix_format, namespace,
+                 counter=None):
+        self.on = on
+        self.directory = directory
+        self.prefix_format = prefix_format
+        self.namespace = namespace
+        # Nested contexts writing to the same directory share a counter.
+        self._counter = [0] if counter is None else counter
+
+    @property
+    def count(self):
+        return self._counter[0]
+
+    @count.setter
+    def count(self, value):
+        self._counter[0] = value
+
+
+class _ContextProxy(object):
+    """Proxy to settings of the current context, falling back to a global
+    jicbioimage settings class outside of any context."""
+
+    def __init__(self, global_cls, names):
+        object.__setattr__(self, "_global_cls", global_cls)
+        object.__setattr__(self, "_names", names)
+
+    def __getattr__(self, name):
+        settings = _current_settings()
+        if settings is not None and name in self._names:
+            return getattr(settings, name)
+        return getattr(self._global_cls, name)
+
+    def __setattr__(self, name, value):
+        settings = _current_settings()
+        if settings is not None and name in self._names:
+            setattr(settings, name, value)
+        else:
+            setattr(self._global_cls, name, value)
+
+
+class _AutoWriteProxy(_ContextProxy):
+    """Context-local replacement for jicbioimage AutoWrite."""
+
+    def __init__(self):
+        _ContextProxy.__init__(self, _GlobalAutoWrite, ("on",))
+
+
+class _AutoNameProxy(_ContextProxy):
+    """Context-local replacement for jicbioimage AutoName."""
+
+    def __init__(self):
+        _ContextProxy.__init__(self, _GlobalAutoName,
+                               ("count", "directory", "prefix_format",
+                                "namespace"))
+
+    def prefix(self):
+        """Return auto generated file prefix."""
+        return self.prefix_format.format(self.count)
+
+    def name(self, func):
+        """Return auto generated file name."""
+        self.count = self.count + 1
+        namespace = getattr(self, "namespace", "")
+        fpath = "{}{}{}".format(self.prefix(), namespace, func.__name__)
+        if self.directory:
+            fpath = os.path.join(self.directory, fpath)
+        return fpath
+
+
+AutoWrite = _AutoWriteProxy()
+AutoName = _AutoNameProxy()
+
+# Make the transformations use the context-local settings.
+jicbioimage.core.transform.AutoWrite = AutoWrite
+jicbioimage.core.transform.AutoName = AutoName
+
+
+@contextlib.contextmanager
+def auto_io(on=None, directory=None, prefix_format=None, namespace=None):
+    """Context manager for auto-writing and auto-naming settings.
+
+    Settings that are not given are inherited from the enclosing context.
+    A context with a new directory numbers its auto-named files from zero;
+    otherwise the numbering continues from the enclosing context."""
+    previous = _current_settings()
+    counter = None
+    if previous is not None and directory is None:
+        counter = previous._counter
+    settings = AutoIOSettings(
+        on=AutoWrite.on if on is None else on,
+        directory=AutoName.directory if directory is None else directory,
+        prefix_format=(AutoName.prefix_format if prefix_format is None
+                       else prefix_format),
+        namespace=(getattr(AutoName, "namespace", "") if namespace is None
+                   else namespace),
+        counter=counter)
+    _set_settings(settings)
+    try:
+        yield settings
+    finally:
+        _set_settings(previous)
@@ -11,13 +11,10 @@ import numpy as np
 import skimage.draw
 
 from jicbioimage.core.util.array import pretty_color_array
-from jicbioimage.core.io import (
-    AutoName,
-    AutoWrite,
-)
 from jicbioimage.illustrate import AnnotatedImage
 from jicbioimage.transform import max_intensity_projection
 
+from autoio import AutoName, auto_io
 from utils import (
     get_microscopy_collection,
     get_wall_intensity_and_mask_images,
@@ -29,9 +26,9 @@ from segment import (
     marker_segmentation,
 )
 from tensor import get_tensors
+from tensorfile import RAW_TENSORS_BINARY_FNAME
 from annotate import (
     annotate_segmentation,
-    annotate_markers,
     annotate_tensors,
     make_transparent,
 )
@@ -44,13 +41,17 @@ warnings.filterwarnings("ignore", module="skimage.morphology.misc")
 AutoName.prefix_format = "{:03d}_"
 
 
-def analyse(microscopy_collection, wall_channel, marker_channel, threshold, max_cell_size):
+def analyse(microscopy_collection, wall_channel, marker_channel, threshold, max_cell_size,
+            workers=None):
     """Do the analysis."""
     # Prepare the input data for the segmentations.
     (wall_intensity2D,
      wall_intensity3D,
      wall_mask2D,
-     wall_mask3D) = get_wall_intensity_and_mask_images(microscopy_collection, wall_channel)
+     wall_mask3D) = get_wall_intensity_and_mask_images(microscopy_collection,
+                                                       wall_channel,
+                                                       keep_intensity3D=False,
+                                                       workers=workers)
     (marker_intensity2D,
      marker_intensity3D) = get_marker_intensity_images(microscopy_collection, marker_channel)
 
@@ -65,10 +66,12 @@ def analyse(microscopy_collection, wall_channel, marker_channel, threshold, max_
     # Get tensors.
     tensors = get_tensors(cells, markers)
 
-    # Write out tensors to a text file.
+    # Write out tensors to a text file and a binary tensor file.
     fpath = os.path.join(AutoName.directory, "raw_tensors.txt")
     with open(fpath, "w") as fh:
         tensors.write_raw_tensors(fh)
+    fpath = os.path.join(AutoName.directory, RAW_TENSORS_BINARY_FNAME)
+    tensors.write_binary_raw_tensors(fpath)
 
     # Write out intensity images.
     fpath = os.path.join(AutoName.directory, "wall_intensity.png")
@@ -107,6 +110,12 @@ def main():
     parser.add_argument("-s", "--max-cell-size",
                         default=10000, type=int,
                         help="Maximum cell size (pixels)")
+    parser.add_argument("-n", "--workers",
+                        default=None, type=int,
+                        help="Number of threads for segmenting z-slices")
+    parser.add_argument("--memmap-zstacks",
+                        default=False, action="store_true",
+                        help="Store z-stacks as memory-mapped arrays")
     parser.add_argument("--debug",
                         default=False, action="store_true")
     args = parser.parse_args()
@@ -116,9 +125,6 @@ def main():
     if not os.path.isdir(args.output_dir):
         os.mkdir(args.output_dir)
 
-
-    AutoName.directory = args.output_dir
-    AutoWrite.on = args.debug
     logging.basicConfig(level=logging.DEBUG if args.debug else logging.INFO)
 
     logging.info("Input file: {}".format(args.input_file))
@@ -127,12 +133,15 @@ def main():
     logging.info("Marker threshold: {}".format(args.threshold))
     logging.info("Max cell size: {}".format(args.max_cell_size))
 
-    microscopy_collection = get_microscopy_collection(args.input_file)
-    analyse(microscopy_collection,
-            wall_channel=args.wall_channel,
-            marker_channel=args.marker_channel,
-            threshold=args.threshold,
-            max_cell_size=args.max_cell_size)
+    microscopy_collection = get_microscopy_collection(
+        args.input_file, memmap_zstacks=args.memmap_zstacks)
+    with auto_io(directory=args.output_dir, on=args.debug):
+        analyse(microscopy_collection,
+                wall_channel=args.wall_channel,
+                marker_channel=args.marker_channel,
+                threshold=args.threshold,
+                max_cell_size=args.max_cell_size,
+                workers=args.workers)
 
 
 if __name__ == "__main__":
@@ -13,12 +13,9 @@ import PIL
 import numpy as np
 import skimage.feature
 
+from jicbioimage.core.image import Image
 from jicbioimage.core.util.array import pretty_color_array
 from jicbioimage.core.transform import transformation
-from jicbioimage.core.io import (
-    AutoName,
-    AutoWrite,
-)
 from jicbioimage.transform import (
     invert,
     dilate_binary,
@@ -27,21 +24,37 @@ from jicbioimage.transform import (
 from jicbioimage.segment import connected_components, watershed_with_seeds
 
 
+from autoio import AutoName, auto_io
 from utils import (
     get_microscopy_collection,
+    get_input_md5,
     threshold_abs,
     identity,
     remove_large_segments,
 )
 from tensor import get_tensors
+from tensorfile import RAW_TENSORS_BINARY_FNAME
 from annotate import make_transparent
 from gaussproj import (
     generate_surface_from_stack,
-    projection_from_stack_and_surface,
+    projections_from_stacks_and_surface,
+    surface_deviation,
+)
+from cache import ArrayCache
+from parallel import (
+    SharedStack,
+    parallel_surface_from_stack,
+    parallel_projections_from_stacks_and_surface,
 )
 
 AutoName.prefix_format = "{:03d}_"
 
+# Parameters of the Gaussian projection.
+SURFACE_SD = (10, 10, 10)
+SURFACE_BLUR_SD = 5
+Z_ABOVE = 1
+Z_BELOW = 9
+
 
 @transformation
 def threshold_adaptive_median(image, block_size):
@@ -79,17 +92,128 @@ def segment_markers(image, wall, threshold):
     return segmentation
 
 
+def gaussian_surface(cell_wall_stack, max_memory=None, downsample=None,
+                     refine_band=None, report_surface_deviation=False,
+                     workers=None, shared_stack=None):
+    """Return the surface used to project the stacks.
+
+    If given, shared_stack is the SharedStack of cell_wall_stack used by the
+    worker processes."""
+    if workers is not None and workers > 1 and downsample is None:
+        if shared_stack is None:
+            shared_stack = cell_wall_stack
+        surface = parallel_surface_from_stack(shared_stack,
+                                              sd=SURFACE_SD,
+                                              surface_blur_sd=SURFACE_BLUR_SD,
+                                              workers=workers,
+                                              max_memory=max_memory)
+    else:
+        surface = generate_surface_from_stack(cell_wall_stack,
+                                              sd=SURFACE_SD,
+                                              surface_blur_sd=SURFACE_BLUR_SD,
+                                              max_memory=max_memory,
+                                              downsample=downsample,
+                                              refine_band=refine_band)
+    if downsample is not None and report_surface_deviation:
+        exact_surface = generate_surface_from_stack(
+            cell_wall_stack,
+            sd=SURFACE_SD,
+            surface_blur_sd=SURFACE_BLUR_SD,
+            max_memory=max_memory)
+        max_dev, mean_dev = surface_deviation(surface, exact_surface)
+        logging.info("Surface deviation: max {}, mean {:.3f}".format(
+            max_dev, mean_dev))
+    return surface
+
+
+def gaussian_projections(microscopy_collection, wall_channel, marker_channel,
+                         max_memory=None, downsample=None, refine_band=None,
+                         report_surface_deviation=False, workers=None,
+                         cache=None, input_md5=None):
+    """Return (cell_wall_projection, marker_projection) tuple.
+
+    If a cache is given, together with the md5 of the input file, the surface
+    and projections are looked up in the cache before being computed."""
+    surface_key = None
+    projection_keys = [None, None]
+    if cache is not None and input_md5 is not None:
+        surface_key = cache.key(kind="surface",
+                                input_md5=input_md5,
+                                channel=wall_channel,
+                                sd=SURFACE_SD,
+                                surface_blur_sd=SURFACE_BLUR_SD,
+                                downsample=downsample,
+                                refine_band=refine_band)
+        projection_keys = [cache.key(kind="projection",
+                                     surface_key=surface_key,
+                                     channel=channel,
+                                     z_above=Z_ABOVE,
+                                     z_below=Z_BELOW)
+                           for channel in (wall_channel, marker_channel)]
+        projections = [cache.get(key) for key in projection_keys]
+        if all(p is not None for p in projections):
+            logging.info("Using cached projections")
+            return tuple(p.view(Image) for p in projections)
+
+    cell_wall_stack = microscopy_collection.zstack_array(c=wall_channel)
+    marker_stack = microscopy_collection.zstack_array(c=marker_channel)
+
+    stacks = [cell_wall_stack, marker_stack]
+    parallel = workers is not None and workers > 1
+
+    # Write the stacks for the worker processes once, for both the surface
+    # and the projections.
+    shared_stacks = [SharedStack(stack) for stack in stacks] \
+        if parallel else [None, None]
+    try:
+        surface = None
+        if surface_key is not None:
+            surface = cache.get(surface_key)
+        if surface is None:
+            surface = gaussian_surface(
+                cell_wall_stack,
+                max_memory=max_memory,
+                downsample=downsample,
+                refine_band=refine_band,
+                report_surface_deviation=report_surface_deviation,
+                workers=workers,
+                shared_stack=shared_stacks[0])
+            if surface_key is not None:
+                surface = cache.put(surface_key, surface)
+
+        if parallel:
+            projections = parallel_projections_from_stacks_and_surface(
+                shared_stacks, surface, Z_ABOVE, Z_BELOW, workers=workers)
+        else:
+            projections = projections_from_stacks_and_surface(
+                stacks, surface, Z_ABOVE, Z_BELOW)
+    finally:
+        for shared_stack in shared_stacks:
+            if shared_stack is not None:
+                shared_stack.close()
+
+    if surface_key is not None:
+        projections = [cache.put(key, p).view(Image)
+                       for key, p in zip(projection_keys, projections)]
+    return tuple(projections)
+
+
 def analyse(microscopy_collection, wall_channel, marker_channel,
-            threshold, max_cell_size):
+            threshold, max_cell_size, max_memory=None, downsample=None,
+            refine_band=None, report_surface_deviation=False, workers=None,
+            cache=None, input_md5=None):
     """Do the analysis."""
     # Prepare the input data for the segmentations.
-    cell_wall_stack = microscopy_collection.zstack_array(c=wall_channel)
-    marker_stack = microscopy_collection.zstack_array(c=marker_channel)
-    surface = generate_surface_from_stack(cell_wall_stack)
-    cell_wall_projection = projection_from_stack_and_surface(cell_wall_stack,
-                                                             surface, 1, 9)
-    marker_projection = projection_from_stack_and_surface(marker_stack,
-                                                          surface, 1, 9)
+    (cell_wall_projection,
+     marker_projection) = gaussian_projections(
+        microscopy_collection, wall_channel, marker_channel,
+        max_memory=max_memory,
+        downsample=downsample,
+        refine_band=refine_band,
+        report_surface_deviation=report_surface_deviation,
+        workers=workers,
+        cache=cache,
+        input_md5=input_md5)
 
     # Perform the segmentation.
     cells, wall = segment_cells(cell_wall_projection, max_cell_size)
@@ -98,10 +222,12 @@ def analyse(microscopy_collection, wall_channel, marker_channel,
     # Get tensors.
     tensors = get_tensors(cells, markers)
 
-    # Write out tensors to a text file.
+    # Write out tensors to a text file and a binary tensor file.
     fpath = os.path.join(AutoName.directory, "raw_tensors.txt")
     with open(fpath, "w") as fh:
         tensors.write_raw_tensors(fh)
+    fpath = os.path.join(AutoName.directory, RAW_TENSORS_BINARY_FNAME)
+    tensors.write_binary_raw_tensors(fpath)
 
     # Write out intensity images.
     fpath = os.path.join(AutoName.directory, "wall_intensity.png")
@@ -141,6 +267,31 @@ def main():
     parser.add_argument("-s", "--max-cell-size",
                         default=10000, type=int,
                         help="Maximum cell size (pixels)")
+    parser.add_argument("--max-memory",
+                        default=None, type=int,
+                        help="Memory budget for surface blurring (MB)")
+    parser.add_argument("--downsample",
+                        default=None, type=int,
+                        help="Estimate the surface at reduced resolution")
+    parser.add_argument("--refine-band",
+                        default=None, type=int,
+                        help="Refine downsampled surface within band (z slices)")
+    parser.add_argument("--report-surface-deviation",
+                        default=False, action="store_true",
+                        help="Log deviation of downsampled from exact surface")
+    parser.add_argument("-n", "--workers",
+                        default=None, type=int,
+                        help="Number of worker processes for the exact "
+                             "surface and the projection")
+    parser.add_argument("--cache-dir",
+                        default=None,
+                        help="Cache surfaces and projections in this directory")
+    parser.add_argument("--cache-size",
+                        default=10240, type=int,
+                        help="Maximum size of the cache (MB)")
+    parser.add_argument("--memmap-zstacks",
+                        default=False, action="store_true",
+                        help="Store z-stacks as memory-mapped arrays")
     parser.add_argument("--debug",
                         default=False, action="store_true")
     args = parser.parse_args()
@@ -150,8 +301,6 @@ def main():
     if not os.path.isdir(args.output_dir):
         os.mkdir(args.output_dir)
 
-    AutoName.directory = args.output_dir
-    AutoWrite.on = args.debug
     logging.basicConfig(level=logging.DEBUG if args.debug else logging.INFO)
 
     logging.info("Input file: {}".format(args.input_file))
@@ -159,13 +308,36 @@ def main():
     logging.info("Marker channel: {}".format(args.marker_channel))
     logging.info("Marker threshold: {}".format(args.threshold))
     logging.info("Max cell size: {}".format(args.max_cell_size))
-
-    microscopy_collection = get_microscopy_collection(args.input_file)
-    analyse(microscopy_collection,
-            wall_channel=args.wall_channel,
-            marker_channel=args.marker_channel,
-            threshold=args.threshold,
-            max_cell_size=args.max_cell_size)
+    if args.workers is not None and args.workers > 1 \
+            and args.downsample is not None:
+        logging.warning("The downsampled surface is calculated in a single "
+                        "process; --workers only applies to the projection")
+
+    max_memory = None
+    if args.max_memory is not None:
+        max_memory = args.max_memory * 1024 * 1024
+
+    microscopy_collection = get_microscopy_collection(
+        args.input_file, memmap_zstacks=args.memmap_zstacks)
+
+    cache = None
+    input_md5 = None
+    if args.cache_dir is not None:
+        cache = ArrayCache(args.cache_dir, args.cache_size * 1024 * 1024)
+        input_md5 = get_input_md5(args.input_file)
+    with auto_io(directory=args.output_dir, on=args.debug):
+        analyse(microscopy_collection,
+                wall_channel=args.wall_channel,
+                marker_channel=args.marker_channel,
+                threshold=args.threshold,
+                max_cell_size=args.max_cell_size,
+                max_memory=max_memory,
+                downsample=args.downsample,
+                refine_band=args.refine_band,
+                report_surface_deviation=args.report_surface_deviation,
+                workers=args.workers,
+                cache=cache,
+                input_md5=input_md5)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,148 @@
+"""Benchmark segmentation post-processing against the number of cells."""
+
+import time
+import argparse
+
+import numpy as np
+import scipy.ndimage as nd
+
+from jicbioimage.segment import SegmentedImage
+
+from autoio import auto_io
+from utils import remove_large_segments
+from tensor import TensorManager, get_tensors
+
+
+def synthetic_segmentation(num_cells, cell_size=100, seed=0):
+    """Return a segmentation tiled with num_cells rectangular cells.
+
+    Cell sizes vary around cell_size so that some cells are larger than
+    others."""
+    random = np.random.RandomState(seed)
+    side = int(np.sqrt(cell_size))
+    cells_per_row = int(np.ceil(np.sqrt(num_cells)))
+    ydim = xdim = cells_per_row * side
+    segmentation = np.zeros((ydim, xdim), dtype=np.int32)
+    identifier = 1
+    for row in range(cells_per_row):
+        for col in range(cells_per_row):
+            if identifier > num_cells:
+                break
+            height = random.randint(side // 2, side + 1)
+            width = random.randint(side // 2, side + 1)
+            segmentation[row*side:row*side+height,
+                         col*side:col*side+width] = identifier
+            identifier += 1
+    return segmentation.view(SegmentedImage)
+
+
+def synthetic_markers(cells, seed=0):
+    """Return a segmentation with a small marker at the corner of each cell.
+    """
+    random = np.random.RandomState(seed)
+    markers = np.zeros(cells.shape, dtype=np.int32)
+    identifier = 1
+    for slc in nd.find_objects(np.asarray(cells)):
+        if slc is None:
+            continue
+        row = slc[0].start + random.randint(0, 2)
+        col = slc[1].start + random.randint(0, 2)
+        markers[row:row+3, col:col+2] = identifier
+        identifier += 1
+    return markers.view(SegmentedImage)
+
+
+def remove_large_segments_per_region(segmentation, max_size):
+    """Reference implementation that tests each region in turn."""
+    for i in segmentation.identifiers:
+        region = segmentation.region_by_identifier(i)
+        if region.area > max_size:
+            segmentation[region] = 0
+    return segmentation
+
+
+def get_tensors_per_region(cells, markers):
+    """Reference implementation that selects each region in turn."""
+    tensor_manager = TensorManager()
+    for tensor_id, marker_id in enumerate(markers.identifiers):
+        m_region = markers.region_by_identifier(marker_id)
+        marker_position = m_region.convex_hull.centroid
+        row, col = [int(i) for i in marker_position]
+        cell_id = cells[row, col]
+        if cell_id == 0:
+            continue
+        centroid = cells.region_by_identifier(cell_id).centroid
+        tensor_manager.create_tensor(tensor_id, centroid, marker_position)
+    return tensor_manager
+
+
+def format_seconds(seconds):
+    """Return seconds formatted for the benchmark table."""
+    if seconds is None:
+        return "{:>12}".format("-")
+    return "{:>11.4f}s".format(seconds)
+
+
+def timed(func, *args, **kwargs):
+    """Return (result, seconds) tuple."""
+    start = time.time()
+    result = func(*args, **kwargs)
+    return result, time.time() - start
+
+
+def benchmark_remove_large_segments(cell_counts, reference_limit):
+    """Time remove_large_segments against the number of cells."""
+    print("remove_large_segments")
+    print("{:>8} {:>12} {:>12}".format("cells", "histogram", "per region"))
+    for num_cells in cell_counts:
+        segmentation = synthetic_segmentation(num_cells)
+        max_size = 80
+        result, seconds = timed(remove_large_segments,
+                                segmentation.copy(), max_size)
+        reference_seconds = None
+        if num_cells <= reference_limit:
+            reference, reference_seconds = timed(
+                remove_large_segments_per_region,
+                segmentation.copy(), max_size)
+            assert np.array_equal(result, reference)
+        print("{:>8d} {} {}".format(num_cells, format_seconds(seconds),
+                                    format_seconds(reference_seconds)))
+
+
+def benchmark_get_tensors(cell_counts, reference_limit):
+    """Time get_tensors against the number of cells."""
+    print("get_tensors")
+    print("{:>8} {:>12} {:>12}".format("cells", "batched", "per region"))
+    for num_cells in cell_counts:
+        cells = synthetic_segmentation(num_cells)
+        markers = synthetic_markers(cells)
+        result, seconds = timed(get_tensors, cells, markers)
+        reference_seconds = None
+        if num_cells <= reference_limit:
+            reference, reference_seconds = timed(get_tensors_per_region,
+                                                 cells, markers)
+            assert result == reference
+        print("{:>8d} {} {}".format(num_cells, format_seconds(seconds),
+                                    format_seconds(reference_seconds)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("-c", "--cell-counts",
+                        default=[100, 500, 1000, 5000, 20000],
+                        type=int, nargs="+",
+                        help="Numbers of cells to benchmark")
+    parser.add_argument("-r", "--reference-limit",
+                        default=5000, type=int,
+                        help="Largest number of cells to time the slow "
+                             "reference implementations on")
+    args = parser.parse_args()
+
+    with auto_io(on=False):
+        benchmark_remove_large_segments(args.cell_counts,
+                                        args.reference_limit)
+        benchmark_get_tensors(args.cell_counts, args.reference_limit)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,136 @@
+"""Module for caching intermediate arrays on disk.
+
+Arrays are stored as .npy files named after a hash of the parameters that
+produced them, so they can be memory-mapped when read back. The cache has a
+size cap; when it is exceeded the least recently used files are removed.
+"""
+
+import os
+import os.path
+import json
+import hashlib
+import shutil
+import logging
+import tempfile
+
+import numpy as np
+
+from utils import HERE
+
+CACHE_DIR = os.path.abspath(os.path.join(HERE, "..", "data", "cache"))
+
+
+class ArrayCache(object):
+    """Content addressed on-disk cache of numpy arrays."""
+
+    def __init__(self, directory=CACHE_DIR, max_bytes=10 * 1024**3):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+    @staticmethod
+    def key(**params):
+        """Return cache key for the given parameters."""
+        text = json.dumps(params, sort_keys=True)
+        return hashlib.md5(text.encode("utf-8")).hexdigest()
+
+    def fpath(self, key):
+        """Return the path of the file storing the array with key."""
+        return os.path.join(self.directory, key + ".npy")
+
+    def __contains__(self, key):
+        return os.path.isfile(self.fpath(key))
+
+    def get(self, key, mmap_mode="r"):
+        """Return the cached array, or None if it is not in the cache."""
+        fpath = self.fpath(key)
+        try:
+            array = np.load(fpath, mmap_mode=mmap_mode)
+        except (IOError, OSError, ValueError):
+            logging.debug("Cache miss: {}".format(key))
+            return None
+        # The modification time records when the entry was last used.
+        os.utime(fpath, None)
+        logging.debug("Cache hit: {}".format(key))
+        return array
+
+    def put(self, key, array):
+        """Store the array in the cache and return it memory-mapped."""
+        fd, tmp_fpath = tempfile.mkstemp(suffix=".tmp", dir=self.directory)
+        with os.fdopen(fd, "wb") as fh:
+            np.save(fh, np.asarray(array))
+        # Renaming makes the entry appear atomically to other processes.
+        os.rename(tmp_fpath, self.fpath(key))
+        logging.debug("Cache store: {}".format(key))
+        self.evict()
+        cached = self.get(key)
+        if cached is None:
+            # The array on its own is larger than the cache.
+            return array
+        return cached
+
+    def evict(self):
+        """Remove least recently used entries until under the size cap."""
+        entries = []
+        for fname in os.listdir(self.directory):
+            if not fname.endswith(".npy"):
+                continue
+            fpath = os.path.join(self.directory, fname)
+            try:
+                stat = os.stat(fpath)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, fpath))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, fpath in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.unlink(fpath)
+            except OSError:
+                continue
+            logging.debug("Cache evict: {}".format(fpath))
+            total -= size
+
+
+def test_array_cache():
+    directory = tempfile.mkdtemp()
+    try:
+        array = np.arange(1000, dtype=np.float64).reshape(10, 100)
+        # Room for three arrays and their .npy headers.
+        cache = ArrayCache(directory, max_bytes=3 * (array.nbytes + 1024))
+
+        # Test that keys depend on the parameters and not their order.
+        key = ArrayCache.key(name="surface", sd=[10, 10, 10], md5="abc")
+        assert key == ArrayCache.key(md5="abc", name="surface",
+                                     sd=[10, 10, 10])
+        assert key != ArrayCache.key(name="surface", sd=[5, 10, 10],
+                                     md5="abc")
+
+        # Test a miss, then a memory-mapped hit.
+        assert key not in cache
+        assert cache.get(key) is None
+        cached = cache.put(key, array)
+        assert key in cache
+        assert isinstance(cached, np.memmap)
+        assert np.array_equal(cached, array)
+        assert np.array_equal(cache.get(key), array)
+
+        # Test that the least recently used entry is evicted first.
+        keys = [ArrayCache.key(index=i) for i in range(3)]
+        cache.put(keys[0], array)
+        cache.put(keys[1], array)
+        for i, k in enumerate([keys[0], key, keys[1]]):
+            os.utime(cache.fpath(k), (i, i))
+        cache.put(keys[2], array)
+        assert keys[0] not in cache
+        assert key in cache and keys[1] in cache and keys[2] in cache
+
+        # Test an array larger than the cache on its own.
+        large = np.zeros(4 * array.size)
+        assert cache.put(ArrayCache.key(size="large"), large) is large
+        assert len(os.listdir(directory)) == 0
+    finally:
+        shutil.rmtree(directory)
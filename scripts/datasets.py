@@ -0,0 +1,196 @@
+"""Module for keeping a bounded number of datasets loaded for editing.
+
+A dataset is an analysis output directory with raw tensors and the images
+shown in the editor. Datasets are loaded on first access; when too many are
+loaded, the least recently used one is evicted, flushing its audit journal.
+"""
+
+import os
+import os.path
+import time
+import logging
+import threading
+import contextlib
+from collections import OrderedDict
+
+import PIL.Image
+
+from tensor import TensorManager
+from tiles import LAYERS, build_tiles
+from audit import (
+    JOURNAL_FNAME,
+    AuditJournal,
+    compact,
+    load_tensor_manager,
+    raw_tensors_fpath,
+)
+
+
+def is_dataset_dir(directory):
+    """Return True if the directory has raw tensors and editor images."""
+    if not os.path.isfile(raw_tensors_fpath(directory)):
+        return False
+    for layer in LAYERS:
+        if not os.path.isfile(os.path.join(directory, layer + ".png")):
+            return False
+    return True
+
+
+def find_dataset_dirs(directories):
+    """Return list of the dataset directories among directories and their
+    subdirectories."""
+    dataset_dirs = []
+    for directory in directories:
+        if is_dataset_dir(directory):
+            dataset_dirs.append(directory)
+            continue
+        for fname in sorted(os.listdir(directory)):
+            subdir = os.path.join(directory, fname)
+            if os.path.isdir(subdir) and is_dataset_dir(subdir):
+                dataset_dirs.append(subdir)
+    return dataset_dirs
+
+
+class Dataset(object):
+    """Tensors and editor images of one analysis output directory."""
+
+    def __init__(self, name, directory, manager_class=TensorManager,
+                 manager_kwargs=None, fsync_every=1):
+        self.name = name
+        self.directory = directory
+        self.manager_class = manager_class
+        self.manager_kwargs = manager_kwargs or {}
+        self.fsync_every = fsync_every
+        # Held while the dataset is being edited, loaded or evicted.
+        self.lock = threading.RLock()
+        self.tensor_manager = None
+        self.tile_manifests = None
+        self.xdim = None
+        self.ydim = None
+        self.num_loads = 0
+        self.num_evictions = 0
+        self.load_seconds = None
+        self.evict_seconds = None
+
+    @property
+    def loaded(self):
+        return self.tensor_manager is not None
+
+    def load(self):
+        """Load the tensors and build any missing tile pyramids."""
+        start = time.time()
+        im = PIL.Image.open(os.path.join(self.directory, "wall_intensity.png"))
+        self.xdim, self.ydim = im.size
+        self.tile_manifests = build_tiles(self.directory)
+        tensor_manager = self.manager_class(**self.manager_kwargs)
+        load_tensor_manager(self.directory, tensor_manager)
+        fpath = os.path.join(self.directory, JOURNAL_FNAME)
+        tensor_manager.journal = AuditJournal(fpath, self.fsync_every)
+        self.tensor_manager = tensor_manager
+        self.num_loads += 1
+        self.load_seconds = time.time() - start
+        logging.debug("Loaded {} in {:.3f}s".format(self.name,
+                                                    self.load_seconds))
+
+    def evict(self):
+        """Flush the audit journal and release the tensors."""
+        start = time.time()
+        self.tensor_manager.journal.close()
+        compact(self.directory)
+        self.tensor_manager = None
+        self.num_evictions += 1
+        self.evict_seconds = time.time() - start
+        logging.debug("Evicted {} in {:.3f}s".format(self.name,
+                                                     self.evict_seconds))
+
+    @property
+    def stats(self):
+        """Return dictionary of load and eviction statistics."""
+        return dict(name=self.name,
+                    directory=self.directory,
+                    loaded=self.loaded,
+                    num_loads=self.num_loads,
+                    num_evictions=self.num_evictions,
+                    load_seconds=self.load_seconds,
+                    evict_seconds=self.evict_seconds)
+
+
+class DatasetRegistry(object):
+    """Datasets by name, with at most max_loaded of them loaded at once."""
+
+    def __init__(self, directories, max_loaded=4, **dataset_kwargs):
+        self.max_loaded = max_loaded
+        self.datasets = OrderedDict()
+        for directory in find_dataset_dirs(directories):
+            name = os.path.basename(os.path.abspath(directory))
+            unique_name = name
+            suffix = 2
+            while unique_name in self.datasets:
+                unique_name = "{}-{:d}".format(name, suffix)
+                suffix += 1
+            self.datasets[unique_name] = Dataset(unique_name, directory,
+                                                 **dataset_kwargs)
+        # Names of the loaded datasets, least recently used first.
+        self._loaded = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __contains__(self, name):
+        return name in self.datasets
+
+    def __len__(self):
+        return len(self.datasets)
+
+    def _mark_used(self, name):
+        """Mark the dataset as the most recently used; return the least
+        recently used datasets beyond max_loaded, no longer marked."""
+        with self._lock:
+            self._loaded.pop(name, None)
+            self._loaded[name] = True
+            to_evict = []
+            while len(self._loaded) > self.max_loaded:
+                evict_name, _ = self._loaded.popitem(last=False)
+                to_evict.append(self.datasets[evict_name])
+        return to_evict
+
+    def _evict(self, dataset):
+        """Evict the dataset, unless it has been marked as used again."""
+        with dataset.lock:
+            with self._lock:
+                if dataset.name in self._loaded:
+                    return
+            if dataset.loaded:
+                dataset.evict()
+
+    @contextlib.contextmanager
+    def use(self, name):
+        """Context manager giving the dataset loaded and locked.
+
+        The least recently used datasets are evicted before the dataset is
+        loaded. It is marked as used again once locked, in case another
+        thread chose it for eviction in between; anything that pushes out is
+        evicted once the dataset is released."""
+        dataset = self.datasets[name]
+        for evicted in self._mark_used(name):
+            self._evict(evicted)
+        to_evict = []
+        try:
+            with dataset.lock:
+                to_evict = self._mark_used(name)
+                if not dataset.loaded:
+                    dataset.load()
+                yield dataset
+        finally:
+            for evicted in to_evict:
+                self._evict(evicted)
+
+    def close(self):
+        """Evict all loaded datasets."""
+        with self._lock:
+            self._loaded.clear()
+        for dataset in self.datasets.values():
+            self._evict(dataset)
+
+    @property
+    def stats(self):
+        """Return list of the statistics of all datasets."""
+        return [dataset.stats for dataset in self.datasets.values()]
@@ -13,50 +13,365 @@ HERE = os.path.dirname(__file__)
 UNPACK = os.path.join(HERE, '..', 'data', 'unpack')
 OUTPUT = os.path.join(HERE, '..', 'output')
 
+# Zero padding applied around the stack before blurring.
+PAD_VAL = 5
 
-def generate_surface_from_stack(stack, sd=(10, 10, 10), surface_blur_sd=5):
+# Side length of the XY tiles in which a surface is refined.
+REFINE_TILE_SIZE = 256
+
+
+def blur_radius(sd, truncate=4.0):
+    """Return the number of pixels either side of a point that contribute to
+    a gaussian blur with the given standard deviation."""
+    return int(truncate * float(sd) + 0.5)
+
+
+def smoothed_substack(stack, sd, rows, cols):
+    """Return the blurred stack restricted to the rows and cols ranges.
+
+    The stack is zero padded by PAD_VAL in every direction before blurring.
+    Only the part of the padded stack within the blur radius of the requested
+    block is read, which gives the same values as blurring the whole padded
+    stack and cropping it afterwards."""
+
+    ydim, xdim, zdim = stack.shape
+    halo_y = blur_radius(sd[0])
+    halo_x = blur_radius(sd[1])
+
+    # Extent of the padded block in stack coordinates.
+    r0 = max(rows[0] - halo_y, -PAD_VAL)
+    r1 = min(rows[1] + halo_y, ydim + PAD_VAL)
+    c0 = max(cols[0] - halo_x, -PAD_VAL)
+    c1 = min(cols[1] + halo_x, xdim + PAD_VAL)
+
+    # Extent of the block that overlaps with the stack.
+    sr0, sr1 = max(r0, 0), min(r1, ydim)
+    sc0, sc1 = max(c0, 0), min(c1, xdim)
+
+    padded_block = np.zeros((r1 - r0, c1 - c0, zdim + 2 * PAD_VAL),
+                            dtype=stack.dtype)
+    padded_block[sr0-r0:sr1-r0, sc0-c0:sc1-c0, PAD_VAL:zdim+PAD_VAL] = \
+        stack[sr0:sr1, sc0:sc1, :]
+    smoothed_block = nd.gaussian_filter(padded_block, sd)
+    return smoothed_block[rows[0]-r0:rows[1]-r0,
+                          cols[0]-c0:cols[1]-c0,
+                          PAD_VAL:zdim+PAD_VAL]
+
+
+def raw_surface_from_smoothed_stack(smoothed_stack):
+    """Return the z index of the brightest point for each X, Y location.
+
+    Locations where the blurred stack is empty are placed at the bottom of
+    the stack."""
+
+    zdim = smoothed_stack.shape[2]
+    raw_surface = np.argmax(smoothed_stack, 2)
+    raw_surface[np.logical_and(raw_surface == 0,
+                               smoothed_stack[:, :, 0] == 0)] = zdim - 1
+    return raw_surface
+
+
+def tile_size_from_memory_budget(stack, sd, max_memory):
+    """Return the side length of square XY tiles such that blurring a tile,
+    including its halo, stays within max_memory bytes."""
+
+    zdim = stack.shape[2]
+    halo = max(blur_radius(sd[0]), blur_radius(sd[1])) + PAD_VAL
+    # The padded block and its blurred copy are held at the same time.
+    bytes_per_column = 2 * (zdim + 2 * PAD_VAL) * stack.dtype.itemsize
+    side = int(np.sqrt(max_memory / float(bytes_per_column))) - 2 * halo
+    if side < 1:
+        raise(ValueError(
+            "Memory budget of {} bytes is too small for a blur halo of {} "
+            "pixels".format(max_memory, halo)))
+    return side
+
+
+def tiled_raw_surface_from_stack(stack, sd, max_memory):
+    """Return the raw surface, processing the stack in XY tiles.
+
+    Each tile is read from the stack together with a halo sized from sd, so
+    the result is identical to the in-memory calculation. The stack can be a
+    memory-mapped array, in which case only one tile is paged in at a time."""
+
+    ydim, xdim, zdim = stack.shape
+    side = tile_size_from_memory_budget(stack, sd, max_memory)
+    raw_surface = np.zeros((ydim, xdim), dtype=np.intp)
+    for row in range(0, ydim, side):
+        rows = (row, min(row + side, ydim))
+        for col in range(0, xdim, side):
+            cols = (col, min(col + side, xdim))
+            smoothed = smoothed_substack(stack, sd, rows, cols)
+            raw_surface[rows[0]:rows[1], cols[0]:cols[1]] = \
+                raw_surface_from_smoothed_stack(smoothed)
+    return raw_surface
+
+
+def downsample_stack(stack, factor):
+    """Return the stack reduced by factor along every axis by block averaging.
+
+    factor can also be a tuple with a factor for each axis. Blocks that
+    overhang the edge of the stack are filled by repeating the last plane.
+    The stack is read one row of blocks at a time, so memory use is bounded
+    by the size of the downsampled stack."""
+
+    factors = (factor,) * 3 if np.isscalar(factor) else tuple(factor)
+    ydim, xdim, zdim = stack.shape
+    coarse_shape = [(dim + f - 1) // f for dim, f in zip(stack.shape, factors)]
+    cydim, cxdim, czdim = coarse_shape
+    fy, fx, fz = factors
+    coarse = np.empty(coarse_shape, dtype=stack.dtype)
+    for row in range(cydim):
+        block_row = np.asarray(stack[row * fy:(row + 1) * fy])
+        padding = [(0, fy - block_row.shape[0]),
+                   (0, cxdim * fx - xdim),
+                   (0, czdim * fz - zdim)]
+        if any(after for _, after in padding):
+            block_row = np.pad(block_row, padding, mode="edge")
+        blocks = block_row.reshape(fy, cxdim, fx, czdim, fz)
+        total = blocks.sum(axis=0, dtype=np.float64).sum(axis=3).sum(axis=1)
+        coarse[row] = np.rint(total / (fy * fx * fz))
+    return coarse
+
+
+def coarse_coordinates(full_coordinates, factor):
+    """Return positions in the downsampled grid of full resolution positions."""
+    return (full_coordinates - (factor - 1) / 2.0) / factor
+
+
+def z_blur_weights(zdim, sd, zs):
+    """Return array with the weight of each of the zdim slices of a stack in
+    each of the slices in the zs range after a gaussian blur along z.
+
+    The stack is zero padded by PAD_VAL, and reflected at the ends of the
+    padded stack, as in smoothed_substack."""
+
+    impulses = np.zeros((zdim + 2 * PAD_VAL, zdim))
+    impulses[PAD_VAL + np.arange(zdim), np.arange(zdim)] = 1
+    weights = nd.gaussian_filter1d(impulses, sd, axis=0)
+    return weights[PAD_VAL + zs[0]:PAD_VAL + zs[1]]
+
+
+def smoothed_band(stack, sd, rows, cols, zs):
+    """Return the blurred stack restricted to the rows, cols and zs ranges,
+    calculated in single precision floating point.
+
+    The stack is zero padded by PAD_VAL in every direction, as in
+    smoothed_substack. The blur along z is applied first, as a weighted sum
+    of the slices, so the X and Y blur is only calculated for the slices in
+    zs."""
+
+    ydim, xdim, zdim = stack.shape
+    halo_y = blur_radius(sd[0])
+    halo_x = blur_radius(sd[1])
+
+    # Extent of the padded block in X and Y, and of its overlap with the
+    # stack.
+    r0 = max(rows[0] - halo_y, -PAD_VAL)
+    r1 = min(rows[1] + halo_y, ydim + PAD_VAL)
+    c0 = max(cols[0] - halo_x, -PAD_VAL)
+    c1 = min(cols[1] + halo_x, xdim + PAD_VAL)
+    sr0, sr1 = max(r0, 0), min(r1, ydim)
+    sc0, sc1 = max(c0, 0), min(c1, xdim)
+
+    # Only read the slices that contribute to the ones in zs.
+    weights = z_blur_weights(zdim, sd[2], zs)
+    used = np.flatnonzero(weights.any(axis=0))
+    block = np.zeros((r1 - r0, c1 - c0, len(used)), dtype=np.float32)
+    block[sr0-r0:sr1-r0, sc0-c0:sc1-c0] = stack[sr0:sr1, sc0:sc1][:, :, used]
+
+    smoothed = np.dot(block, weights[:, used].T.astype(np.float32))
+    smoothed = nd.gaussian_filter1d(smoothed, sd[0], axis=0)
+    smoothed = nd.gaussian_filter1d(smoothed, sd[1], axis=1)
+    return smoothed[rows[0]-r0:rows[1]-r0, cols[0]-c0:cols[1]-c0]
+
+
+def refine_surface(stack, sd, surface, refine_band):
+    """Return the surface moved to the brightest z index of the blurred stack
+    within refine_band slices of its current position.
+
+    The stack is processed in XY tiles, each blurred only in the range of z
+    slices covered by its band. For integer stacks the blurred values are
+    rounded down, as nd.gaussian_filter does, so that ties are resolved
+    towards low z indices in the same way as for the exact surface.
+    Locations where the blurred stack is empty across the band are left
+    unchanged."""
+
+    ydim, xdim, zdim = stack.shape
+    offsets = np.arange(-refine_band, refine_band + 1)
+    refined = surface.copy()
+    side = REFINE_TILE_SIZE
+    for row in range(0, ydim, side):
+        rows = (row, min(row + side, ydim))
+        for col in range(0, xdim, side):
+            cols = (col, min(col + side, xdim))
+            tile = surface[rows[0]:rows[1], cols[0]:cols[1]]
+            zs = (max(int(tile.min()) - refine_band, 0),
+                  min(int(tile.max()) + refine_band + 1, zdim))
+            smoothed = smoothed_band(stack, sd, rows, cols, zs)
+            if np.issubdtype(stack.dtype, np.integer):
+                smoothed = np.floor(smoothed)
+
+            # Blurred values at the z indices of the band of each location.
+            z = np.clip(tile[:, :, np.newaxis] + offsets, 0, zdim - 1)
+            tile_rows, tile_cols, _ = np.ogrid[0:z.shape[0], 0:z.shape[1],
+                                               0:len(offsets)]
+            values = smoothed[tile_rows, tile_cols, z - zs[0]]
+
+            best = np.argmax(values, axis=2)
+            best_z = z[tile_rows[:, :, 0], tile_cols[:, :, 0], best]
+            nonempty = values.max(axis=2) > 0
+            refined[rows[0]:rows[1], cols[0]:cols[1]] = \
+                np.where(nonempty, best_z, tile)
+    return refined
+
+
+def pyramid_raw_surface_from_stack(stack, sd, factor, refine_band=None,
+                                   max_memory=None):
+    """Return the raw surface estimated from a downsampled copy of the stack.
+
+    The stack is reduced by factor in every direction and blurred with sd
+    scaled to match. The coarse height map is scaled back to full resolution
+    z indices. If refine_band is given it is then refined in a band of that
+    many z slices either side, against a copy of the stack reduced by factor
+    in X and Y only, which keeps the full z resolution. The result is
+    linearly upsampled in X and Y."""
+
+    ydim, xdim, zdim = stack.shape
+    coarse_stack = downsample_stack(stack, factor)
+    coarse_sd = [s / float(factor) for s in sd]
+    cydim, cxdim, czdim = coarse_stack.shape
+
+    if max_memory is not None:
+        coarse_surface = tiled_raw_surface_from_stack(coarse_stack, coarse_sd,
+                                                      max_memory)
+    else:
+        smoothed_coarse = smoothed_substack(coarse_stack, coarse_sd,
+                                            (0, cydim), (0, cxdim))
+        coarse_surface = raw_surface_from_smoothed_stack(smoothed_coarse)
+
+    # Scale the coarse z indices to full resolution.
+    coarse_surface = coarse_surface * factor + (factor - 1) / 2.0
+    if refine_band is not None:
+        xy_stack = downsample_stack(stack, (factor, factor, 1))
+        xy_sd = (coarse_sd[0], coarse_sd[1], sd[2])
+        coarse_surface = np.clip(np.rint(coarse_surface), 0, zdim - 1)
+        coarse_surface = refine_surface(xy_stack, xy_sd,
+                                        coarse_surface.astype(np.intp),
+                                        refine_band)
+
+    # Upsample in X and Y.
+    rows, cols = np.mgrid[0:ydim, 0:xdim]
+    surface = nd.map_coordinates(coarse_surface.astype(np.float64),
+                                 [coarse_coordinates(rows, factor),
+                                  coarse_coordinates(cols, factor)],
+                                 order=1, mode="nearest", output=np.float64)
+    return np.clip(np.rint(surface), 0, zdim - 1).astype(np.intp)
+
+
+def surface_deviation(surface, reference):
+    """Return (max, mean) absolute deviation of surface from reference."""
+    difference = np.abs(surface.astype(np.float64) - reference)
+    return difference.max(), difference.mean()
+
+
+def generate_surface_from_stack(stack, sd=(10, 10, 10), surface_blur_sd=5,
+                                max_memory=None, downsample=None,
+                                refine_band=None):
     """Return a 2D image encoding a height map, generated from the input stack.
     The image is generated by first blurring the stack, then taking the z index
     of the brightest point for each X, Y location. The resultant surface is
     then smoothed with a gaussian filter.
 
     sd: standard deviation in each direction
-    surface_blur_sd: standard deviation of smoothing applied to 2D surface."""
+    surface_blur_sd: standard deviation of smoothing applied to 2D surface
+    max_memory: if given, process the stack in XY tiles using at most this
+                many bytes for the blurring of each tile
+    downsample: if given, estimate the surface from a copy of the stack
+                reduced by this factor in every direction
+    refine_band: when downsampling, move the coarse surface to the brightest
+                 point within this many z slices either side, using all the
+                 z slices of the stack."""
 
+    if np.isscalar(sd):
+        sd = (sd, sd, sd)
 
     ydim, xdim, zdim = stack.shape
-    pad_val = 5
-    padding = pad_val * 2
-    padded_stack = np.zeros((ydim + padding, xdim + padding, zdim + padding),
-                            dtype=stack.dtype)
-    start = pad_val
-    end_add = pad_val
-    padded_stack[start:ydim+end_add, start:xdim+end_add, start:zdim+end_add] = stack
-    smoothed_stack = nd.gaussian_filter(padded_stack, sd)
-    cropped_stack = smoothed_stack[start:ydim+end_add, start:xdim+end_add, start:zdim+end_add]
-    raw_surface = np.argmax(cropped_stack, 2)
-    raw_surface[np.logical_and(raw_surface==0, cropped_stack[:,:,0] == 0)] = zdim-1
+    if downsample is not None and downsample > 1:
+        raw_surface = pyramid_raw_surface_from_stack(stack, sd, downsample,
+                                                     refine_band, max_memory)
+    elif max_memory is None:
+        cropped_stack = smoothed_substack(stack, sd, (0, ydim), (0, xdim))
+        raw_surface = raw_surface_from_smoothed_stack(cropped_stack)
+    else:
+        raw_surface = tiled_raw_surface_from_stack(stack, sd, max_memory)
     smoothed_surface = nd.gaussian_filter(raw_surface, surface_blur_sd)
 
     return smoothed_surface
 
+def projection_window_from_surface(surface, zdim, z_above=1, z_below=1):
+    """Return (z_min, num_z) arrays describing the z-slab used for each X, Y
+    location when projecting a stack with zdim z-slices onto the surface.
+
+    The slab starts at z_min and contains num_z slices; it is clipped to the
+    extent of the stack in the same way as the original per-pixel loop."""
+
+    z_index = np.asarray(surface).astype(np.int64)
+    z_min = np.clip(z_index - z_above, 0, zdim - 1)
+    z_max = np.clip(z_index + z_below, 1, zdim)
+    num_z = np.maximum(z_max - z_min, 0)
+    return z_min, num_z
+
+
+def projections_from_window(stacks, z_min, num_z):
+    """Return list with the mean of each z-slab defined by z_min and num_z in
+    each of the stacks as uint8 arrays. Empty slabs project to zero.
+
+    The stacks must have the same shape. The slab indices are computed once
+    per z-offset and used to gather from every stack."""
+
+    xdim, ydim, zdim = stacks[0].shape
+    rows, cols = np.ogrid[0:xdim, 0:ydim]
+    totals = [np.zeros(z_min.shape, dtype=np.float64) for _ in stacks]
+    max_num_z = int(num_z.max()) if num_z.size else 0
+    for offset in range(max_num_z):
+        z = np.minimum(z_min + offset, zdim - 1)
+        in_window = num_z > offset
+        for stack, total in zip(stacks, totals):
+            total += np.where(in_window, stack[rows, cols, z], 0)
+    has_slab = num_z > 0
+    count = np.maximum(num_z, 1)
+    return [np.where(has_slab, total / count, 0).astype(np.uint8)
+            for total in totals]
+
+
+def projections_from_stacks_and_surface(stacks, surface, z_above=1,
+                                        z_below=1):
+    """Return list of 2D projections of the 3D stacks onto a single surface.
+
+    The z-slab for each point in the plane is computed from the surface once
+    and shared by all the stacks, which must have the same shape."""
+
+    zdim = stacks[0].shape[2]
+    z_min, num_z = projection_window_from_surface(surface, zdim,
+                                                  z_above, z_below)
+    projections = projections_from_window(stacks, z_min, num_z)
+
+    return [projection.view(Image) for projection in projections]
+
+
 def projection_from_stack_and_surface(stack, surface, z_above=1, z_below=1):
     """Return a 2D projection of a 3D stack. The projection is obtained by
     using the elements of the 2D array surface as the Z index for each
-    point in the plane."""
+    point in the plane.
 
-    projection = np.zeros(surface.shape, dtype=np.uint8)
+    Rather than looping over every X, Y location the slabs are gathered one
+    z-offset at a time, so the number of passes is bounded by
+    z_above + z_below rather than by the number of pixels."""
 
-    xdim, ydim, zdim = stack.shape
-    for x in range(xdim):
-        for y in range(ydim):
-            z_index = surface[x, y]
-            z_min = min(zdim - 1, max(0, z_index-z_above))
-            z_max = max(1, min(zdim, z_index+z_below))
-            value = np.mean(stack[x, y, z_min:z_max])
-            projection[x, y] = value
+    return projections_from_stacks_and_surface([stack], surface,
+                                               z_above, z_below)[0]
 
-    return projection.view(Image)
 
 def save_image(filename, image):
     """Save the given image to a file."""
@@ -82,10 +397,9 @@ def generate_projections_from_microscope_image(input_file,
 
     surface = generate_surface_from_stack(cell_wall_stack)
 
-    cell_wall_projection = projection_from_stack_and_surface(cell_wall_stack,
-                                                             surface, 5, 5)
-    marker_projection = projection_from_stack_and_surface(marker_stack,
-                                                          surface, 5, 5)
+    (cell_wall_projection,
+     marker_projection) = projections_from_stacks_and_surface(
+        [cell_wall_stack, marker_stack], surface, 5, 5)
 
 
     save_image("wall.png", cell_wall_projection)
@@ -93,6 +407,82 @@ def generate_projections_from_microscope_image(input_file,
     pil_im = PIL.Image.fromarray(surface.astype(np.uint8))
     pil_im.save('surface.png')
 
+def test_projection_from_stack_and_surface():
+    stack = np.random.randint(0, 256, (20, 30, 12)).astype(np.uint8)
+    # Include surfaces beyond either end of the stack.
+    surface = np.random.randint(-3, 16, (20, 30))
+
+    # Compare with the original loop over every X, Y location.
+    expected = np.zeros(surface.shape, dtype=np.uint8)
+    xdim, ydim, zdim = stack.shape
+    for x in range(xdim):
+        for y in range(ydim):
+            z_index = surface[x, y]
+            z_min = min(zdim - 1, max(0, z_index-1))
+            z_max = max(1, min(zdim, z_index+1))
+            if z_max > z_min:
+                expected[x, y] = np.mean(stack[x, y, z_min:z_max])
+    projection = projection_from_stack_and_surface(stack, surface)
+    assert np.array_equal(projection, expected)
+
+    # Test projecting several stacks onto the same surface.
+    other = np.random.randint(0, 256, stack.shape).astype(np.uint8)
+    projections = projections_from_stacks_and_surface([stack, other], surface)
+    assert np.array_equal(projections[0], projection)
+    assert np.array_equal(projections[1],
+                          projection_from_stack_and_surface(other, surface))
+
+
+def test_tiled_raw_surface_from_stack():
+    stack = np.random.randint(0, 256, (50, 40, 16)).astype(np.uint8)
+    sd = (2, 3, 2)
+
+    # Test a block with its halo against the blur of the whole padded stack.
+    padded = np.pad(stack, PAD_VAL, mode="constant")
+    expected = nd.gaussian_filter(padded, sd)[PAD_VAL:-PAD_VAL,
+                                              PAD_VAL:-PAD_VAL,
+                                              PAD_VAL:-PAD_VAL]
+    block = smoothed_substack(stack, sd, (10, 30), (0, 17))
+    assert np.array_equal(block, expected[10:30, 0:17])
+
+    # Test the tiled surface, with tiles of a few pixels, against the
+    # surface from the whole stack.
+    raw_surface = raw_surface_from_smoothed_stack(expected)
+    max_memory = 2 * (16 + 2 * PAD_VAL) * (2 * (PAD_VAL + 12) + 7)**2
+    assert tile_size_from_memory_budget(stack, sd, max_memory) == 7
+    tiled = tiled_raw_surface_from_stack(stack, sd, max_memory)
+    assert np.array_equal(tiled, raw_surface)
+
+
+def test_pyramid_raw_surface_from_stack():
+    # Bright wall following a smooth height map, above a noisy background.
+    ydim, xdim, zdim = 96, 80, 40
+    rows, cols = np.mgrid[0:ydim, 0:xdim]
+    height = 20 + 6 * np.sin(rows / 20.0) * np.cos(cols / 25.0)
+    wall = np.exp(-(np.arange(zdim) - height[:, :, np.newaxis])**2 / 8.0)
+    stack = 200 * wall * (np.random.rand(ydim, xdim, 1) > 0.3)
+    stack = (stack + 20 * np.random.rand(ydim, xdim, zdim)).astype(np.uint8)
+    sd = (4, 4, 4)
+
+    # Test a band against the float blur of the whole padded stack.
+    padded = np.pad(stack.astype(np.float64), PAD_VAL, mode="constant")
+    expected = nd.gaussian_filter(padded, sd)[PAD_VAL:-PAD_VAL,
+                                              PAD_VAL:-PAD_VAL,
+                                              PAD_VAL:-PAD_VAL]
+    band = smoothed_band(stack, sd, (10, 30), (0, 17), (12, 25))
+    assert np.allclose(band, expected[10:30, 0:17, 12:25], atol=1e-3)
+
+    # Test the deviation of the estimated surfaces from the exact one.
+    smoothed = smoothed_substack(stack, sd, (0, ydim), (0, xdim))
+    exact = raw_surface_from_smoothed_stack(smoothed)
+    surface = pyramid_raw_surface_from_stack(stack, sd, 4)
+    max_dev, mean_dev = surface_deviation(surface, exact)
+    assert max_dev <= 3 and mean_dev < 1.5
+    refined = pyramid_raw_surface_from_stack(stack, sd, 4, refine_band=2)
+    max_dev, mean_dev = surface_deviation(refined, exact)
+    assert max_dev <= 1 and mean_dev < 0.4
+
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('input_file', help="Input microscope file.")
@@ -0,0 +1,242 @@
+"""Module for running the Gaussian projection across several processes.
+
+The stacks are stored in files that each worker memory-maps, so they are
+never pickled. Work is split into XY strips; blurring reads each strip with
+a halo, which makes the results identical to the serial functions in
+gaussproj.
+"""
+
+import os
+import os.path
+import mmap
+import shutil
+import tempfile
+import multiprocessing
+
+import numpy as np
+import scipy.ndimage as nd
+
+from jicbioimage.core.image import Image
+
+from gaussproj import (
+    smoothed_substack,
+    raw_surface_from_smoothed_stack,
+    tile_size_from_memory_budget,
+    projection_window_from_surface,
+    projections_from_window,
+)
+
+# Stacks opened by a worker process, set up by _init_worker.
+_worker_stacks = []
+
+
+class SharedStack(object):
+    """Stack stored in a file that can be memory-mapped by worker processes.
+
+    A stack that is already a memory-mapped .npy file is used in place;
+    any other array is written to a temporary .npy file once."""
+
+    def __init__(self, stack):
+        self._tmp_dir = None
+        if not self._is_file_backed(stack):
+            self._tmp_dir = tempfile.mkdtemp(prefix="gaussproj_")
+            fpath = os.path.join(self._tmp_dir, "stack.npy")
+            np.save(fpath, np.asarray(stack))
+            stack = np.load(fpath, mmap_mode="r")
+        self.filename = stack.filename
+        self.offset = stack.offset
+        self.dtype = stack.dtype.str
+        self.shape = stack.shape
+        self.order = "F" if stack.flags.f_contiguous and \
+            not stack.flags.c_contiguous else "C"
+
+    @staticmethod
+    def _is_file_backed(stack):
+        """Return True if stack is a memmap that maps its whole file region.
+
+        Slices of a memmap keep the filename and offset of their parent, so
+        only the array that owns the mapping can be reopened by a worker."""
+        return (isinstance(stack, np.memmap)
+                and stack.filename is not None
+                and isinstance(stack.base, mmap.mmap))
+
+    def open(self):
+        """Return a read only memory map of the stack."""
+        return np.memmap(self.filename, dtype=np.dtype(self.dtype), mode="r",
+                         shape=self.shape, offset=self.offset,
+                         order=self.order)
+
+    def close(self):
+        """Remove the temporary file, if one was written."""
+        if self._tmp_dir is not None:
+            shutil.rmtree(self._tmp_dir, ignore_errors=True)
+            self._tmp_dir = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def _shared_stacks(stacks):
+    """Return list of (SharedStack, owned) tuples for stacks given as arrays
+    or SharedStack instances; owned is True for those created here, which
+    the caller closes."""
+    return [(stack, False) if isinstance(stack, SharedStack)
+            else (SharedStack(stack), True) for stack in stacks]
+
+
+def _close_owned(shared_stacks):
+    for shared_stack, owned in shared_stacks:
+        if owned:
+            shared_stack.close()
+
+
+def _init_worker(shared_stacks):
+    """Open the shared stacks in a worker process."""
+    global _worker_stacks
+    _worker_stacks = [s.open() for s in shared_stacks]
+
+
+def _raw_surface_block(args):
+    """Return the raw surface of a block of the first shared stack."""
+    sd, rows, cols = args
+    smoothed = smoothed_substack(_worker_stacks[0], sd, rows, cols)
+    return raw_surface_from_smoothed_stack(smoothed)
+
+
+def _projection_strip(args):
+    """Return the projections of a strip of rows of every shared stack."""
+    rows, z_min, num_z = args
+    stacks = [stack[rows[0]:rows[1]] for stack in _worker_stacks]
+    return projections_from_window(stacks, z_min, num_z)
+
+
+def strips(dim, num_strips):
+    """Return list of (start, end) ranges splitting dim into num_strips."""
+    bounds = np.linspace(0, dim, num_strips + 1).astype(int)
+    return [(int(s), int(e)) for s, e in zip(bounds[:-1], bounds[1:]) if e > s]
+
+
+def _run(shared_stacks, workers, func, tasks):
+    """Map func over tasks in a pool of workers with the stacks opened."""
+    pool = multiprocessing.Pool(workers, initializer=_init_worker,
+                                initargs=(shared_stacks,))
+    try:
+        return pool.map(func, tasks)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def parallel_surface_from_stack(stack, sd=(10, 10, 10), surface_blur_sd=5,
+                                workers=None, max_memory=None):
+    """Return the same surface as gaussproj.generate_surface_from_stack,
+    blurring XY strips of the stack in a pool of worker processes.
+
+    The stack can be given as a SharedStack, so that it is only written out
+    once when it is also projected.
+
+    workers: number of processes (defaults to the number of CPUs)
+    max_memory: if given, limit the blurring of each block to this many bytes
+                per worker."""
+
+    if np.isscalar(sd):
+        sd = (sd, sd, sd)
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+
+    shared_stacks = _shared_stacks([stack])
+    try:
+        shared_stack = shared_stacks[0][0]
+        ydim, xdim, zdim = shared_stack.shape
+        if max_memory is None:
+            blocks = [(rows, (0, xdim)) for rows in strips(ydim, workers)]
+        else:
+            side = tile_size_from_memory_budget(shared_stack.open(), sd,
+                                                max_memory)
+            blocks = [(rows, cols)
+                      for rows in strips(ydim, (ydim + side - 1) // side)
+                      for cols in strips(xdim, (xdim + side - 1) // side)]
+        tasks = [(sd, rows, cols) for rows, cols in blocks]
+        results = _run([shared_stack], workers, _raw_surface_block, tasks)
+    finally:
+        _close_owned(shared_stacks)
+
+    raw_surface = np.zeros((ydim, xdim), dtype=np.intp)
+    for (rows, cols), block in zip(blocks, results):
+        raw_surface[rows[0]:rows[1], cols[0]:cols[1]] = block
+    return nd.gaussian_filter(raw_surface, surface_blur_sd)
+
+
+def parallel_projections_from_stacks_and_surface(stacks, surface, z_above=1,
+                                                 z_below=1, workers=None):
+    """Return list of projections of the stacks onto the surface, projecting
+    strips of rows in a pool of worker processes.
+
+    All stacks must have the same shape. The results are identical to
+    calling gaussproj.projection_from_stack_and_surface on each stack. The
+    stacks can be given as SharedStack instances."""
+
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+
+    ydim, xdim, zdim = stacks[0].shape
+    z_min, num_z = projection_window_from_surface(surface, zdim,
+                                                  z_above, z_below)
+    row_strips = strips(ydim, workers)
+    tasks = [(rows, z_min[rows[0]:rows[1]], num_z[rows[0]:rows[1]])
+             for rows in row_strips]
+
+    shared_stacks = _shared_stacks(stacks)
+    try:
+        results = _run([s for s, _ in shared_stacks], workers,
+                       _projection_strip, tasks)
+    finally:
+        _close_owned(shared_stacks)
+
+    projections = []
+    for i in range(len(stacks)):
+        projection = np.concatenate([strip[i] for strip in results])
+        projections.append(projection.view(Image))
+    return projections
+
+
+def test_parallel_matches_serial():
+    from gaussproj import (
+        generate_surface_from_stack,
+        projections_from_stacks_and_surface,
+    )
+
+    wall = np.random.randint(0, 256, (40, 30, 12)).astype(np.uint8)
+    marker = np.random.randint(0, 256, (40, 30, 12)).astype(np.uint8)
+    sd = (2, 2, 2)
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        fpath = os.path.join(tmp_dir, "wall.npy")
+        np.save(fpath, wall)
+        memmap_wall = np.load(fpath, mmap_mode="r")
+
+        expected = generate_surface_from_stack(wall, sd, 2)
+        for stack in (wall, memmap_wall):
+            surface = parallel_surface_from_stack(stack, sd, 2, workers=2)
+            assert np.array_equal(surface, expected)
+            surface = parallel_surface_from_stack(stack, sd, 2, workers=2,
+                                                  max_memory=80000)
+            assert np.array_equal(surface, expected)
+
+        expected = projections_from_stacks_and_surface([wall, marker],
+                                                       expected, 2, 1)
+        for stack in (wall, memmap_wall):
+            with SharedStack(stack) as shared_wall:
+                surface = parallel_surface_from_stack(shared_wall, sd, 2,
+                                                      workers=2)
+                projections = parallel_projections_from_stacks_and_surface(
+                    [shared_wall, marker], surface, 2, 1, workers=2)
+            for projection, expected_projection in zip(projections,
+                                                       expected):
+                assert np.array_equal(projection, expected_projection)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
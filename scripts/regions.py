@@ -0,0 +1,53 @@
+"""Module for measuring all regions of a segmentation at once.
+
+Rather than selecting each region from the full image in turn, regions are
+measured with label-indexed reductions over the whole image, or on patches
+cropped to the bounding box of each region.
+"""
+
+import numpy as np
+import scipy.ndimage as nd
+import skimage.morphology
+
+
+def region_slices(segmentation):
+    """Return dictionary mapping identifiers to bounding box slices."""
+    labels = np.asarray(segmentation)
+    slices = {}
+    for index, slc in enumerate(nd.find_objects(labels)):
+        if slc is not None:
+            slices[index + 1] = slc
+    return slices
+
+
+def region_centroids(segmentation):
+    """Return dictionary mapping identifiers to (row, col) centroids.
+
+    The centroids are the same as those given by Region.centroid, calculated
+    from per-label sums of the pixel coordinates in a single pass."""
+    labels = np.asarray(segmentation).astype(np.intp, copy=False)
+    ydim, xdim = labels.shape
+    flat_labels = labels.ravel()
+    rows = np.repeat(np.arange(ydim, dtype=np.float64), xdim)
+    cols = np.tile(np.arange(xdim, dtype=np.float64), ydim)
+    counts = np.bincount(flat_labels)
+    row_sums = np.bincount(flat_labels, weights=rows)
+    col_sums = np.bincount(flat_labels, weights=cols)
+    centroids = {}
+    for identifier in np.nonzero(counts)[0]:
+        if identifier == 0:
+            continue
+        count = counts[identifier]
+        centroids[identifier] = (row_sums[identifier] / count,
+                                 col_sums[identifier] / count)
+    return centroids
+
+
+def convex_hull_centroid(patch, slc):
+    """Return (row, col) centroid of the convex hull of a region, given as a
+    boolean patch cropped to its bounding box slc.
+
+    This gives the same result as Region.convex_hull.centroid."""
+    hull = skimage.morphology.convex_hull_image(patch)
+    rows, cols = np.nonzero(hull)
+    return (np.mean(rows + slc[0].start), np.mean(cols + slc[1].start))
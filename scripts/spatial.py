@@ -0,0 +1,191 @@
+"""Module for finding points near a position or inside a rectangle.
+
+Points are bucketed into the square cells of a regular grid, so that a query
+only needs to look at the points in the few cells it overlaps.
+"""
+
+import math
+import heapq
+
+import numpy as np
+
+
+def points_in_polygon(points, polygon):
+    """Return boolean array, True for the (row, col) points inside the
+    polygon given as a list of (row, col) vertices."""
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    polygon = np.asarray(polygon, dtype=np.float64).reshape(-1, 2)
+    rows, cols = points[:, 0], points[:, 1]
+    inside = np.zeros(len(points), dtype=bool)
+    # Count the crossings of a ray from each point along the columns.
+    for (row1, col1), (row2, col2) in zip(polygon,
+                                          np.roll(polygon, -1, axis=0)):
+        crosses = (row1 > rows) != (row2 > rows)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            crossing_col = col1 + (rows - row1) * (col2 - col1) / (row2 - row1)
+        inside ^= crosses & (cols < crossing_col)
+    return inside
+
+
+class GridIndex(object):
+    """Spatial index of (row, col) points stored by key."""
+
+    def __init__(self, cell_size=64):
+        self.cell_size = float(cell_size)
+        self.points = {}
+        self.cells = {}
+        self._bounds = None
+
+    def __len__(self):
+        return len(self.points)
+
+    def __contains__(self, key):
+        return key in self.points
+
+    def _cell(self, point):
+        return (int(math.floor(point[0] / self.cell_size)),
+                int(math.floor(point[1] / self.cell_size)))
+
+    def insert(self, key, point):
+        """Add a point, replacing any previous point stored by key."""
+        point = (float(point[0]), float(point[1]))
+        if key in self.points:
+            self.remove(key)
+        self.points[key] = point
+        cell = self._cell(point)
+        self.cells.setdefault(cell, set()).add(key)
+        # Bounds of the occupied cells; they are never shrunk on removal.
+        if self._bounds is None:
+            self._bounds = [cell[0], cell[1], cell[0], cell[1]]
+        else:
+            self._bounds = [min(self._bounds[0], cell[0]),
+                            min(self._bounds[1], cell[1]),
+                            max(self._bounds[2], cell[0]),
+                            max(self._bounds[3], cell[1])]
+
+    def remove(self, key):
+        """Remove the point stored by key."""
+        point = self.points.pop(key)
+        cell = self._cell(point)
+        keys = self.cells[cell]
+        keys.discard(key)
+        if not keys:
+            del self.cells[cell]
+
+    def query_box(self, min_row, min_col, max_row, max_col):
+        """Return list of keys of the points inside the rectangle."""
+        if not self.points:
+            return []
+        min_cell_row, min_cell_col = self._cell((min_row, min_col))
+        max_cell_row, max_cell_col = self._cell((max_row, max_col))
+        min_cell_row = max(min_cell_row, self._bounds[0])
+        min_cell_col = max(min_cell_col, self._bounds[1])
+        max_cell_row = min(max_cell_row, self._bounds[2])
+        max_cell_col = min(max_cell_col, self._bounds[3])
+        keys = []
+        for cell_row in range(min_cell_row, max_cell_row + 1):
+            for cell_col in range(min_cell_col, max_cell_col + 1):
+                for key in self.cells.get((cell_row, cell_col), ()):
+                    row, col = self.points[key]
+                    if min_row <= row <= max_row and min_col <= col <= max_col:
+                        keys.append(key)
+        return keys
+
+    def within_radius(self, point, radius):
+        """Return list of keys of the points within radius of point,
+        nearest first."""
+        row, col = point
+        candidates = self.query_box(row - radius, col - radius,
+                                    row + radius, col + radius)
+        found = []
+        for key in candidates:
+            distance = self._distance(key, point)
+            if distance <= radius:
+                found.append((distance, key))
+        return [key for _, key in sorted(found)]
+
+    def nearest(self, point, k=1):
+        """Return list of keys of the k points nearest to point, nearest
+        first."""
+        if not self.points or k < 1:
+            return []
+        cell_row, cell_col = self._cell(point)
+        max_ring = max(abs(cell_row - self._bounds[0]),
+                       abs(cell_row - self._bounds[2]),
+                       abs(cell_col - self._bounds[1]),
+                       abs(cell_col - self._bounds[3]))
+        heap = []
+        ring = 0
+        while ring <= max_ring:
+            for cell in self._ring_cells(cell_row, cell_col, ring):
+                for key in self.cells.get(cell, ()):
+                    item = (-self._distance(key, point), key)
+                    if len(heap) < k:
+                        heapq.heappush(heap, item)
+                    elif item > heap[0]:
+                        heapq.heapreplace(heap, item)
+            # Points outside the rings searched are further away than this.
+            if len(heap) == k and -heap[0][0] <= ring * self.cell_size:
+                break
+            ring += 1
+        return [key for _, key in sorted((-d, key) for d, key in heap)]
+
+    def _distance(self, key, point):
+        row, col = self.points[key]
+        return math.hypot(row - point[0], col - point[1])
+
+    @staticmethod
+    def _ring_cells(cell_row, cell_col, ring):
+        """Yield the cells at Chebyshev distance ring from a cell."""
+        if ring == 0:
+            yield (cell_row, cell_col)
+            return
+        for col in range(cell_col - ring, cell_col + ring + 1):
+            yield (cell_row - ring, col)
+            yield (cell_row + ring, col)
+        for row in range(cell_row - ring + 1, cell_row + ring):
+            yield (row, cell_col - ring)
+            yield (row, cell_col + ring)
+
+
+def test_grid_index():
+    points = np.random.uniform(-100, 500, (300, 2))
+    index = GridIndex(cell_size=32)
+    for key, point in enumerate(points):
+        index.insert(key, point)
+
+    # Test moving and removing points.
+    index.insert(0, (250.5, 250.5))
+    points[0] = (250.5, 250.5)
+    for key in range(1, 50):
+        index.remove(key)
+    keys = np.concatenate([[0], np.arange(50, len(points))])
+    assert len(index) == len(keys)
+    assert 0 in index and 1 not in index
+
+    # Compare the queries with brute force searches.
+    rows, cols = points[keys, 0], points[keys, 1]
+    for _ in range(20):
+        (min_row, max_row), (min_col, max_col) = np.sort(
+            np.random.uniform(-150, 550, (2, 2)))
+        inside = ((rows >= min_row) & (rows <= max_row)
+                  & (cols >= min_col) & (cols <= max_col))
+        found = index.query_box(min_row, min_col, max_row, max_col)
+        assert sorted(found) == sorted(keys[inside])
+
+        point = np.random.uniform(-300, 700, 2)
+        distances = np.hypot(rows - point[0], cols - point[1])
+        order = keys[np.argsort(distances)]
+        radius = np.random.uniform(0, 200)
+        num_within = np.sum(distances <= radius)
+        assert index.within_radius(point, radius) == list(order[:num_within])
+        for k in (1, 5, len(keys) + 1):
+            assert index.nearest(point, k) == list(order[:k])
+
+
+def test_points_in_polygon():
+    # An L shaped polygon in (row, col) vertices.
+    polygon = [(0, 0), (0, 10), (4, 10), (4, 4), (10, 4), (10, 0)]
+    points = [(2, 2), (2, 8), (8, 2), (8, 8), (-1, 2), (2, 11)]
+    inside = points_in_polygon(points, polygon)
+    assert list(inside) == [True, True, True, False, False, False]
@@ -13,6 +13,7 @@ function toggleChannels() {
     wall_intensity.setAttribute("visibility", "visible");
     marker_intensity.setAttribute("visibility", "hidden");
   }
+  updateTiles();
 }
 
 function toggleSegmentation() {
@@ -31,6 +32,83 @@ function toggleSegmentation() {
     document.getElementById("Triangle").classList.add("intensityTheme");
     document.getElementById("tensors").classList.add("intensityTheme");
   }
+  updateTiles();
+}
+
+function tileLevel(manifest, scale) {
+  // Use the level with the lowest resolution that is at least as high as
+  // that of the screen.
+  var level = Math.floor(Math.log(1 / scale) / Math.LN2);
+  return Math.max(0, Math.min(level, manifest["levels"].length - 1));
+}
+
+function updateTiles() {
+  // Add the tiles in view of the visible image layers.
+  var svg = document.getElementById("svg");
+  var ctm = svg.getScreenCTM();
+  var inverse = ctm.inverse();
+  var pt = svg.createSVGPoint();
+  pt.x = 0;
+  pt.y = 0;
+  var top_left = pt.matrixTransform(inverse);
+  pt.x = window.innerWidth;
+  pt.y = window.innerHeight;
+  var bottom_right = pt.matrixTransform(inverse);
+
+  var layers = document.getElementsByClassName("tile-layer");
+  for (var i = 0; i < layers.length; i++) {
+    var group = layers[i];
+    if (group.getAttribute("visibility") == "hidden") {
+      continue;
+    }
+    var layer = group.getAttribute("data-layer");
+    var manifest = tile_manifests[layer];
+    var level = tileLevel(manifest, ctm.a);
+    var info = manifest["levels"][level];
+    var tile_size = manifest["tile_size"];
+    var factor = Math.pow(2, level);
+    var span = tile_size * factor;
+
+    // Drop the tiles of another level when the zoom changes.
+    if (group.getAttribute("data-level") != String(level)) {
+      while (group.firstChild) {
+        group.removeChild(group.firstChild);
+      }
+      group.setAttribute("data-level", level);
+    }
+
+    var first_row = Math.max(0, Math.floor(top_left.y / span));
+    var last_row = Math.min(info["rows"] - 1, Math.floor(bottom_right.y / span));
+    var first_col = Math.max(0, Math.floor(top_left.x / span));
+    var last_col = Math.min(info["cols"] - 1, Math.floor(bottom_right.x / span));
+    for (var row = first_row; row <= last_row; row++) {
+      for (var col = first_col; col <= last_col; col++) {
+        var tile_id = group.id + "-" + level + "-" + row + "-" + col;
+        if (document.getElementById(tile_id)) {
+          continue;
+        }
+        var width = Math.min(tile_size, info["width"] - col * tile_size);
+        var height = Math.min(tile_size, info["height"] - row * tile_size);
+        var url = "tiles/" + layer + "/" + manifest["version"] + "/" + level
+                  + "/" + row + "_" + col + ".png";
+        var tile = document.createElementNS("http://www.w3.org/2000/svg", "image");
+        tile.setAttribute("id", tile_id);
+        tile.setAttribute("x", col * span);
+        tile.setAttribute("y", row * span);
+        tile.setAttribute("width", width * factor);
+        tile.setAttribute("height", height * factor);
+        tile.setAttributeNS("http://www.w3.org/1999/xlink", "xlink:href", url);
+        group.appendChild(tile);
+      }
+    }
+  }
+}
+
+function zoom(factor) {
+  var svg = document.getElementById("svg");
+  svg.setAttribute("width", svg.getAttribute("width") * factor);
+  svg.setAttribute("height", svg.getAttribute("height") * factor);
+  updateTiles();
 }
 
 function clearSelection(event) {
@@ -137,23 +215,66 @@ function add_tensor_from_json(info) {
 }
 
 function action_from_json(info) {
-  if (info["action"] == "update") {
+  if (Array.isArray(info)) {
+    // Batch edit.
+    for (var i = 0; i < info.length; i++) {
+      action_from_json(info[i]);
+    }
+  } else if (info["action"] == "update") {
     update_tensor_from_json(info);
   } else if (info["action"] == "create") {
     add_tensor_from_json(info);
   }
 }
 
+function remove_tensor(tensor_id) {
+  var prefixes = ["tensor-", "marker-", "centroid-"];
+  for (var i = 0; i < prefixes.length; i++) {
+    var e = document.getElementById(prefixes[i] + tensor_id);
+    if (e) {
+      e.parentNode.removeChild(e);
+    }
+  }
+}
+
+function syncTensors() {
+  // Ajax call.
+  var xhttp = new XMLHttpRequest();
+  var url = "tensors?since=" + tensors_version + "&epoch=" + tensors_epoch;
+  xhttp.onreadystatechange = function() {
+    if (xhttp.readyState == 4 && xhttp.status == 200) {
+      var changes = JSON.parse(xhttp.responseText);
+      if (changes["reset"]) {
+        // The tensors have been reloaded on the server.
+        location.reload();
+        return;
+      }
+      for (var i = 0; i < changes["deleted"].length; i++) {
+        remove_tensor(changes["deleted"][i]);
+      }
+      for (var i = 0; i < changes["tensors"].length; i++) {
+        var info = changes["tensors"][i];
+        if (!document.getElementById("tensor-" + info["tensor_id"])) {
+          add_tensor_from_json(info);
+        }
+        update_tensor_from_json(info);
+      }
+      tensors_version = changes["version"];
+    }
+  };
+  xhttp.open("GET", url, true);
+  xhttp.send()
+}
+
 function undo(event) {
   // Ajax call.
   var xhttp = new XMLHttpRequest();
   var url = "undo"
   xhttp.onreadystatechange = function() {
     if (xhttp.readyState == 4 && xhttp.status == 200) {
-      if (!xhttp.responseText.startsWith("None")) {
-        var info = JSON.parse(xhttp.responseText);
-        action_from_json(info);
-      }
+      // Undoing a creation deletes the tensor, which the response does not
+      // describe, so fetch the changes instead.
+      syncTensors();
     }
   };
   xhttp.open("POST", url, true);
@@ -166,10 +287,7 @@ function redo(event) {
   var url = "redo"
   xhttp.onreadystatechange = function() {
     if (xhttp.readyState == 4 && xhttp.status == 200) {
-      if (!xhttp.responseText.startsWith("None")) {
-        var info = JSON.parse(xhttp.responseText);
-        action_from_json(info);
-      }
+      syncTensors();
     }
   };
   xhttp.open("POST", url, true);
@@ -315,28 +433,82 @@ function downloadEncodedURL(url, name) {
 }
 
 
+function fetchDataURL(url, callback) {
+  // Call callback with the resource at url as a data URL, or with null if it
+  // could not be fetched.
+  var xhttp = new XMLHttpRequest();
+  xhttp.open("GET", url, true);
+  xhttp.responseType = "blob";
+  xhttp.onload = function() {
+    if (xhttp.status != 200) {
+      callback(null);
+      return;
+    }
+    var reader = new FileReader();
+    reader.onload = function() {
+      callback(reader.result);
+    };
+    reader.readAsDataURL(xhttp.response);
+  };
+  xhttp.onerror = function() {
+    callback(null);
+  };
+  xhttp.send();
+}
+
 function downloadSVG() {
-  var svg = document.getElementById("svg");
-  var serializer = new XMLSerializer();
-  var source = serializer.serializeToString(svg);
-  source = '<?xml version="1.0"?>\n' + source;
-  var url = "data:image/svg+xml;charset=utf-1," + encodeURIComponent(source);
+  // Export a copy of the SVG with each tile layer replaced by its full
+  // resolution image embedded as a data URL, so that the export does not
+  // depend on the editor or on the tiles in view.
+  var svg = document.getElementById("svg").cloneNode(true);
+  var layers = svg.getElementsByClassName("tile-layer");
+  var num_pending = layers.length;
+
+  function serializeAndDownload() {
+    var serializer = new XMLSerializer();
+    var source = serializer.serializeToString(svg);
+    source = '<?xml version="1.0"?>\n' + source;
+    var url = "data:image/svg+xml;charset=utf-8," + encodeURIComponent(source);
+    downloadEncodedURL(url, "tensor.svg");
+  }
+
+  function embedImage(group) {
+    var layer = group.getAttribute("data-layer");
+    var info = tile_manifests[layer]["levels"][0];
+    while (group.firstChild) {
+      group.removeChild(group.firstChild);
+    }
+    fetchDataURL("images/" + layer + ".png", function(data_url) {
+      if (data_url) {
+        var image = document.createElementNS("http://www.w3.org/2000/svg", "image");
+        image.setAttribute("x", 0);
+        image.setAttribute("y", 0);
+        image.setAttribute("width", info["width"]);
+        image.setAttribute("height", info["height"]);
+        image.setAttributeNS("http://www.w3.org/1999/xlink", "xlink:href", data_url);
+        group.appendChild(image);
+      }
+      else {
+        console.log("Could not embed the " + layer + " image");
+      }
+      num_pending -= 1;
+      if (num_pending == 0) {
+        serializeAndDownload();
+      }
+    });
+  }
 
-  downloadEncodedURL(url, "tensor.svg");
+  for (var i = 0; i < layers.length; i++) {
+    embedImage(layers[i]);
+  }
+  if (num_pending == 0) {
+    serializeAndDownload();
+  }
 }
 
 function downloadCSV() {
-  var xhttp = new XMLHttpRequest();
-  var url = "csv"
-  xhttp.onreadystatechange = function() {
-    if (xhttp.readyState == 4 && xhttp.status == 200) {
-      var csv = "data:text/csv;charset=utf-1," + xhttp.responseText;
-      var url = encodeURI(csv);
-      downloadEncodedURL(url, "tensor.csv");
-    }
-  };
-  xhttp.open("POST", url, true);
-  xhttp.send()
+  // Let the browser save the streamed csv straight to disk.
+  downloadEncodedURL("csv", "tensor.csv");
 }
 
 function init() {
@@ -356,4 +528,8 @@ function init() {
   document.getElementById("cell_wall_intensity").onmousedown = mouseDownOnCanvas;
   document.getElementById("marker_intensity").onmousedown = mouseDownOnCanvas;
   document.getElementById("segmentation").onmousedown = mouseDownOnCanvas;
+
+  window.addEventListener("scroll", updateTiles);
+  window.addEventListener("resize", updateTiles);
+  updateTiles();
 }
@@ -4,14 +4,33 @@ import os
 import os.path
 import copy
 import json
+import time
+import uuid
+import numbers
 import logging
+from collections import namedtuple, OrderedDict
 
-from utils import marker_cell_identifier
+import numpy as np
+
+from regions import region_centroids
+from spatial import GridIndex, points_in_polygon
+from tensorfile import (
+    RECORD_DTYPE,
+    is_binary_tensor_file,
+    integral_flags,
+    read_records,
+    records_from_dicts,
+    typed_values,
+    write_records,
+)
+from utils import marker_cell_assignment
 
 
 class Tensor(object):
     """Class for managing individual tensors."""
 
+    __slots__ = ("_data",)
+
     def __init__(self, tensor_id, centroid, marker, creation_type):
         self._data = dict(tensor_id=tensor_id,
                           centroid=list(centroid),
@@ -27,9 +46,15 @@ class Tensor(object):
         suffix = ")>"
         info = []
         for key in Tensor.keys():
-            info.append("{}={}".format(key, self._data[key]))
+            info.append("{}={}".format(key, self._get(key)))
         return prefix + ", ".join(info) + suffix
 
+    def _get(self, name):
+        return self._data[name]
+
+    def _set(self, name, value):
+        self._data[name] = value
+
     @staticmethod
     def keys():
         return ["tensor_id", "centroid", "marker", "creation_type", "active"]
@@ -64,86 +89,199 @@ class Tensor(object):
     @property
     def tensor_id(self):
         """Return the tensor identifier."""
-        return self._data["tensor_id"]
+        return self._get("tensor_id")
 
     @property
     def centroid(self):
         """Return the cell centroid position."""
-        return self._data["centroid"]
+        return self._get("centroid")
 
     @property
     def centroid_row(self):
         """Return the cell centroid row."""
-        return self._data["centroid"][0]
+        return self._get("centroid")[0]
 
     @property
     def centroid_col(self):
         """Return the cell centroid column."""
-        return self._data["centroid"][1]
+        return self._get("centroid")[1]
 
     @property
     def marker(self):
         """Return the membrane marker position."""
-        return self._data["marker"]
+        return self._get("marker")
 
     @property
     def marker_row(self):
         """Return the membrane marker row."""
-        return self._data["marker"][0]
+        return self._get("marker")[0]
 
     @property
     def marker_col(self):
         """Return the membrane marker column."""
-        return self._data["marker"][1]
+        return self._get("marker")[1]
 
     @property
     def creation_type(self):
         """Return the creation type (automated/manual)."""
-        return self._data["creation_type"]
+        return self._get("creation_type")
 
     @property
     def active(self):
         """Return the active status of the tensor (True/False)."""
-        return self._data["active"]
+        return self._get("active")
 
     def update(self, name, value):
         """Update a property of the tensor.
 
         :returns: json string describing update
         """
-        self._data[name] = value
+        self._set(name, value)
         d = dict(tensor_id=self.tensor_id, action="update")
         d[name] = value
         logging.debug(json.dumps(d))
         return json.dumps(d)
 
 
-class Command(object):
-    """Command class to enable undo/redo functionality."""
+def audit_json(op):
+    """Return json string describing the effect of an operation.
 
-    def __init__(self, do_method, undo_method, do_args, undo_args):
-        self.do_method = do_method
-        self.do_args = do_args
-        self.undo_method = undo_method
-        self.undo_args = undo_args
-        self.audit_log = None
+    A batch operation is described by one line per operation."""
+    action, tensor_id = op[0], op[1]
+    if action == "batch":
+        return "\n".join(audit_json(o) for o in op[1])
+    elif action == "update":
+        d = dict(tensor_id=tensor_id, action="update")
+        d[op[2]] = op[3]
+    elif action == "create":
+        d = dict(tensor_id=tensor_id, centroid=op[2], marker=op[3],
+                 creation_type=op[4], active=True, action="create")
+    else:
+        d = dict(tensor_id=tensor_id, action=action)
+    return json.dumps(d)
 
-    def do(self):
-        """Execute a command."""
-        self.audit_log = self.do_method(*self.do_args)
-        return self.audit_log
 
-    def undo(self):
-        """Reverse the effect of a command."""
-        return self.undo_method(*self.undo_args)
+class Command(namedtuple("Command", ["do_op", "undo_op"])):
+    """Command class to enable undo/redo functionality.
+
+    The command is a pair of operations, each a tuple of an action and its
+    arguments: ("create", tensor_id, centroid, marker, creation_type),
+    ("delete", tensor_id), ("update", tensor_id, name, value) or
+    ("batch", operations)."""
+
+    __slots__ = ()
+
+    @property
+    def audit_log(self):
+        """Return json string describing the effect of the command."""
+        return audit_json(self.do_op)
 
 
 class TensorManager(dict):
-    """Class for creating, storing and editing tensors."""
+    """Class for creating, storing and editing tensors.
+
+    Spatial indexes of the centroids and markers are kept up to date as
+    tensors are created, moved and deleted.
 
-    def __init__(self):
+    Every change to the tensors increments the version, so that clients can
+    ask for only the tensors changed since the version they last saw."""
+
+    def __init__(self, cell_size=64, coalesce_window=None, max_history=None):
         self.commands = []
         self.command_offset = 0
+        # Consecutive moves of the same point within this many seconds of
+        # each other are merged into a single command.
+        self.coalesce_window = coalesce_window
+        self._last_move = None
+        # Number of commands kept for undo; older ones are dropped.
+        self.max_history = max_history
+        # Commands dropped from the undo history, without their undo
+        # operations, so that the audit log still includes them.
+        self._dropped_commands = []
+        # Optional audit.AuditJournal recording the edits as they are made.
+        self.journal = None
+        self.spatial_index = dict(centroid=GridIndex(cell_size),
+                                  marker=GridIndex(cell_size))
+        self.version = 0
+        # Version at which each tensor was last changed, oldest first.
+        self._changes = OrderedDict()
+        # Versions are only comparable within the same epoch; a manager
+        # loaded afresh from the same files starts a new one.
+        self.epoch = uuid.uuid4().hex
+
+    def __setitem__(self, tensor_id, tensor):
+        dict.__setitem__(self, tensor_id, tensor)
+        self._index_tensor(tensor_id)
+        self._record_change(tensor_id)
+
+    def __delitem__(self, tensor_id):
+        dict.__delitem__(self, tensor_id)
+        self._unindex_tensor(tensor_id)
+        self._record_change(tensor_id)
+
+    # The dict methods below go through __setitem__ and __delitem__, so that
+    # the spatial indexes and the change feed stay up to date.
+
+    def pop(self, tensor_id, *default):
+        if tensor_id not in self:
+            if default:
+                return default[0]
+            raise KeyError(tensor_id)
+        tensor = self[tensor_id]
+        del self[tensor_id]
+        return tensor
+
+    def popitem(self):
+        if len(self) == 0:
+            raise KeyError("popitem(): no tensors")
+        tensor_id = list(self.keys())[-1]
+        return tensor_id, self.pop(tensor_id)
+
+    def clear(self):
+        for tensor_id in list(self.keys()):
+            del self[tensor_id]
+
+    def update(self, *args, **kwargs):
+        for tensor_id, tensor in dict(*args, **kwargs).items():
+            self[tensor_id] = tensor
+
+    def setdefault(self, tensor_id, default=None):
+        if tensor_id not in self:
+            self[tensor_id] = default
+        return self[tensor_id]
+
+    def _record_change(self, tensor_id):
+        self.version += 1
+        # Move the tensor to the end of the change feed.
+        self._changes.pop(tensor_id, None)
+        self._changes[tensor_id] = self.version
+
+    def changes_since(self, version):
+        """Return (identifiers of the tensors created or updated, identifiers
+        of the tensors deleted) since version."""
+        changed = []
+        deleted = []
+        for tensor_id in reversed(self._changes):
+            if self._changes[tensor_id] <= version:
+                break
+            if tensor_id in self:
+                changed.append(tensor_id)
+            else:
+                deleted.append(tensor_id)
+        return sorted(changed), sorted(deleted)
+
+    def _index_tensor(self, tensor_id):
+        tensor = self[tensor_id]
+        for name, index in self.spatial_index.items():
+            index.insert(tensor_id, getattr(tensor, name))
+
+    def _unindex_tensor(self, tensor_id):
+        for index in self.spatial_index.values():
+            index.remove(tensor_id)
+
+    def _index_value(self, tensor_id, name, value):
+        if name in self.spatial_index:
+            self.spatial_index[name].insert(tensor_id, value)
 
     def __eq__(self, other):
         if len(self) != len(other):
@@ -163,34 +301,165 @@ class TensorManager(dict):
 
     @property
     def audit_log(self):
-        """Return list of commands excluding undone ones."""
+        """Return list of commands excluding undone ones.
+
+        Commands dropped from the undo history are included."""
         num_commands = len(self.commands) + self.command_offset
-        return [self.commands[i] for i in range(num_commands)]
+        return self._dropped_commands + [self.commands[i]
+                                         for i in range(num_commands)]
 
     @property
     def csv(self):
         """Return list of csv lines."""
-        lines = []
-        lines.append(Tensor.csv_header())
-        for tensor_id in self.identifiers:
-            tensor = self[tensor_id]
-            lines.append(tensor.csv_line)
-        return lines
+        return list(self.iter_csv())
+
+    @staticmethod
+    def _csv_columns(columns):
+        if columns is None:
+            return Tensor.extended_keys()
+        for column in columns:
+            if column not in Tensor.extended_keys():
+                raise ValueError("Unknown csv column: {}".format(column))
+        return list(columns)
+
+    def iter_csv(self, columns=None, active_only=False, chunk_size=65536):
+        """Return generator of csv lines, starting with the header.
+
+        The tensors are copied when it is called, so the lines are not
+        affected by later edits. They are formatted a column of chunk_size
+        tensors at a time.
+
+        columns: list of columns (defaults to Tensor.extended_keys())
+        active_only: skip inactive tensors"""
+        columns = self._csv_columns(columns)
+        records, creation_type_names = self.records()
+        if active_only:
+            records = records[records["active"]]
+        return self._iter_csv(records, creation_type_names, columns,
+                              chunk_size)
+
+    @staticmethod
+    def _iter_csv(records, creation_type_names, columns, chunk_size):
+        yield ",".join(columns)
+        for start in range(0, len(records), chunk_size):
+            chunk = records[start:start + chunk_size]
+            fields = []
+            for column in columns:
+                if column == "creation_type":
+                    codes = chunk["creation_type"].tolist()
+                    fields.append([creation_type_names[c] for c in codes])
+                elif column in ("tensor_id", "active"):
+                    fields.append(map(str, chunk[column].tolist()))
+                else:
+                    # Coordinates are written as Tensor.csv_line writes them.
+                    name, axis = column.rsplit("_", 1)
+                    kind = ["centroid", "marker"].index(name)
+                    axis = ["row", "col"].index(axis)
+                    values = chunk[name][:, axis].tolist()
+                    integral = chunk["integral"][:, kind, axis]
+                    if integral.any():
+                        values = typed_values(values, integral)
+                    fields.append(map(str, values))
+            for line in map(",".join, zip(*fields)):
+                yield line
+
+    def _active_filter(self, tensor_ids, active_only):
+        if not active_only:
+            return tensor_ids
+        return [i for i in tensor_ids if self[i].active]
+
+    def query_box(self, min_row, min_col, max_row, max_col, kind="centroid",
+                  active_only=False):
+        """Return list of identifiers of tensors with their centroid (or
+        marker) inside the rectangle."""
+        tensor_ids = self.spatial_index[kind].query_box(min_row, min_col,
+                                                        max_row, max_col)
+        return sorted(self._active_filter(tensor_ids, active_only))
+
+    def within_radius(self, point, radius, kind="centroid",
+                      active_only=False):
+        """Return list of identifiers of tensors with their centroid (or
+        marker) within radius of point, nearest first."""
+        tensor_ids = self.spatial_index[kind].within_radius(point, radius)
+        return self._active_filter(tensor_ids, active_only)
+
+    def nearest(self, point, k=1, kind="centroid", active_only=False):
+        """Return list of identifiers of the k tensors with their centroid
+        (or marker) nearest to point, nearest first."""
+        index = self.spatial_index[kind]
+        num_query = k
+        while True:
+            tensor_ids = self._active_filter(index.nearest(point, num_query),
+                                             active_only)
+            if len(tensor_ids) >= k or num_query >= len(index):
+                return tensor_ids[:k]
+            num_query *= 2
+
+    def _apply(self, op):
+        """Apply an operation, returning json string describing it."""
+        action = op[0]
+        if action == "update":
+            return self._update_tensor(*op[1:])
+        elif action == "create":
+            return self.create_tensor(*op[1:])
+        elif action == "delete":
+            return self._delete_tensor(*op[1:])
+        elif action == "batch":
+            infos = [self._apply(o) for o in op[1]]
+            return "[{}]".format(", ".join(i for i in infos if i is not None))
+        raise(RuntimeError)
+
+    def tensors_in_polygon(self, polygon, kind="centroid", active_only=False):
+        """Return list of identifiers of tensors with their centroid (or
+        marker) inside the polygon given as a list of (row, col) vertices.
+
+        Raises ValueError unless the polygon has at least three vertices,
+        each a pair of finite numbers."""
+        if (not isinstance(polygon, (list, tuple)) or len(polygon) < 3
+                or not all(self._is_position(v) for v in polygon)):
+            raise ValueError("Invalid polygon {!r}".format(polygon))
+        rows = [vertex[0] for vertex in polygon]
+        cols = [vertex[1] for vertex in polygon]
+        tensor_ids = self.query_box(min(rows), min(cols), max(rows), max(cols),
+                                    kind, active_only)
+        index = self.spatial_index[kind]
+        points = [index.points[tensor_id] for tensor_id in tensor_ids]
+        inside = points_in_polygon(points, polygon)
+        return [i for i, is_inside in zip(tensor_ids, inside) if is_inside]
 
     def run_command(self, cmd):
         """Add command to command list and run it."""
+        self._last_move = None
+        try:
+            info = self._apply(cmd.do_op)
+        except Exception:
+            # Put back any values the command had already changed.
+            if cmd.do_op[0] in ("update", "batch"):
+                self._apply(cmd.undo_op)
+            raise
+
         # Clip future if running a new command.
         if self.command_offset != 0:
             self.commands = self.commands[:self.command_offset]
             self.command_offset = 0
-
-        # Add the command to the history and run it.
         self.commands.append(cmd)
-        self.commands[-1].do()
+        if self.journal is not None:
+            self.journal.append(cmd.audit_log)
+
+        # Older commands are still in the journal.
+        if self.max_history is not None:
+            num_dropped = len(self.commands) - self.max_history
+            if num_dropped > 0:
+                self._dropped_commands.extend(
+                    Command(dropped.do_op, None)
+                    for dropped in self.commands[:num_dropped])
+                del self.commands[:num_dropped]
+        return info
 
     def undo(self):
         """Undo the last action."""
         logging.debug("Undoing...")
+        self._last_move = None
         # Command offset will be negative if we have already undone things.
         cmd_index = -1 + self.command_offset
         # Basic checking to ensure that there is something to undo.
@@ -198,20 +467,25 @@ class TensorManager(dict):
             logging.debug("Nothing to undo...")
             return None
 
-        info = self.commands[cmd_index].undo()
+        info = self._apply(self.commands[cmd_index].undo_op)
         self.command_offset -= 1
+        if self.journal is not None:
+            self.journal.undo()
         return info
 
     def redo(self):
         """Redo the last action."""
         logging.debug("Redoing...")
+        self._last_move = None
         # Basic checking to ensure that there is something to redo.
         if self.command_offset >= 0:
             logging.debug("Nothing to redo...")
             return None
         cmd_index = self.command_offset
-        info = self.commands[cmd_index].do()
+        info = self._apply(self.commands[cmd_index].do_op)
         self.command_offset += 1
+        if self.journal is not None:
+            self.journal.redo()
         return info
 
     def create_tensor(self, tensor_id, centroid, marker,
@@ -238,44 +512,109 @@ class TensorManager(dict):
         For manual editing with undo.
         """
         tensor_id = max(self.identifiers) + 1
-        cmd = Command(do_method=self.create_tensor,
-                      undo_method=self._delete_tensor,
-                      do_args=[tensor_id, centroid, marker, "manual"],
-                      undo_args=[tensor_id])
-        self.run_command(cmd)
-        return cmd.audit_log
+        cmd = Command(("create", tensor_id, list(centroid), list(marker),
+                       "manual"),
+                      ("delete", tensor_id))
+        return self.run_command(cmd)
+
+    def _update_tensor(self, tensor_id, name, value):
+        """Never call this directly."""
+        info = self[tensor_id].update(name, value)
+        self._index_value(tensor_id, name, value)
+        self._record_change(tensor_id)
+        return info
 
     def inactivate_tensor(self, tensor_id):
         """Mark a tensor as inactive."""
-        tensor = self[tensor_id]
-        cmd = Command(do_method=tensor.update,
-                      undo_method=tensor.update,
-                      do_args=["active", False],
-                      undo_args=["active", True])
-        self.run_command(cmd)
-        return cmd.audit_log
+        cmd = Command(("update", tensor_id, "active", False),
+                      ("update", tensor_id, "active", self[tensor_id].active))
+        return self.run_command(cmd)
+
+    def _move(self, tensor_id, name, new_position):
+        """Move the centroid or marker of a tensor."""
+        do_op = ("update", tensor_id, name, list(new_position))
+        now = time.time()
+        last_move = self._last_move
+        if (self.coalesce_window and last_move is not None and self.commands
+                and last_move[0] == (tensor_id, name)
+                and now - last_move[1] <= self.coalesce_window):
+            # Merge with the previous move, keeping its undo operation.
+            cmd = Command(do_op, self.commands[-1].undo_op)
+            self.commands[-1] = cmd
+            info = self._apply(do_op)
+            if self.journal is not None:
+                self.journal.amend(cmd.audit_log)
+        else:
+            prev_position = getattr(self[tensor_id], name)
+            cmd = Command(do_op, ("update", tensor_id, name, prev_position))
+            info = self.run_command(cmd)
+        self._last_move = ((tensor_id, name), now)
+        return info
+
+    def apply_batch(self, updates):
+        """Apply a list of updates as a single undoable command.
+
+        Each update is a dictionary with a tensor_id and new values for any
+        of "centroid", "marker" and "active", as in the audit log.
+
+        :returns: json string listing the updates, or None if there are none
+        """
+        do_ops = []
+        undo_ops = []
+        values = {}
+        for update in updates:
+            update = dict(update)
+            tensor_id = update.pop("tensor_id")
+            tensor = self[tensor_id]
+            for name, value in update.items():
+                value = self._checked_value(name, value)
+                key = (tensor_id, name)
+                prev_value = values.get(key, getattr(tensor, name))
+                values[key] = value
+                do_ops.append(("update", tensor_id, name, value))
+                undo_ops.append(("update", tensor_id, name, prev_value))
+        if not do_ops:
+            return None
+        undo_ops.reverse()
+        cmd = Command(("batch", tuple(do_ops)), ("batch", tuple(undo_ops)))
+        return self.run_command(cmd)
+
+    @staticmethod
+    def _checked_value(name, value):
+        """Return the value of an update, raising ValueError if it is not a
+        (row, col) position for a centroid or marker, or a bool for active."""
+        if name == "active":
+            if not isinstance(value, bool):
+                raise ValueError("Invalid active value {!r}".format(value))
+            return value
+        if name not in ("centroid", "marker"):
+            raise ValueError("Cannot update {}".format(name))
+        if not TensorManager._is_position(value):
+            raise ValueError("Invalid {} position {!r}".format(name, value))
+        return list(value)
+
+    @staticmethod
+    def _is_position(value):
+        """Return True if the value is a (row, col) pair of finite numbers."""
+        return (isinstance(value, (list, tuple)) and len(value) == 2
+                and all(isinstance(v, numbers.Real)
+                        and not isinstance(v, bool)
+                        and np.isfinite(v) for v in value))
+
+    def inactivate_many(self, tensor_ids):
+        """Mark the active tensors among tensor_ids as inactive, as a single
+        undoable command."""
+        updates = [dict(tensor_id=tensor_id, active=False)
+                   for tensor_id in tensor_ids if self[tensor_id].active]
+        return self.apply_batch(updates)
 
     def update_centroid(self, tensor_id, new_position):
         """Update the position of a centroid."""
-        tensor = self[tensor_id]
-        prev_position = tensor.centroid
-        cmd = Command(do_method=tensor.update,
-                      undo_method=tensor.update,
-                      do_args=["centroid", list(new_position)],
-                      undo_args=["centroid", prev_position])
-        self.run_command(cmd)
-        return cmd.audit_log
+        return self._move(tensor_id, "centroid", new_position)
 
     def update_marker(self, tensor_id, new_position):
         """Update the position of a marker."""
-        tensor = self[tensor_id]
-        prev_position = tensor.marker
-        cmd = Command(do_method=tensor.update,
-                      undo_method=tensor.update,
-                      do_args=["marker", list(new_position)],
-                      undo_args=["marker", prev_position])
-        self.run_command(cmd)
-        return cmd.audit_log
+        return self._move(tensor_id, "marker", new_position)
 
     def read_raw_tensors(self, fh):
         """Read in raw tensors from file."""
@@ -290,6 +629,39 @@ class TensorManager(dict):
             if tensor.creation_type == "automated":
                 fh.write("{}\n".format(tensor.json))
 
+    def read_records(self, records, creation_type_names):
+        """Read in tensors from records of the binary tensor file format."""
+        for record in records:
+            tensor = Tensor(int(record["tensor_id"]),
+                            typed_values(record["centroid"].tolist(),
+                                         record["integral"][0]),
+                            typed_values(record["marker"].tolist(),
+                                         record["integral"][1]),
+                            creation_type_names[record["creation_type"]])
+            tensor._set("active", bool(record["active"]))
+            self[tensor.tensor_id] = tensor
+
+    def records(self, automated_only=False):
+        """Return (records, creation type names) of the tensors in the binary
+        tensor file format."""
+        tensors = [self[tensor_id]._data for tensor_id in self.identifiers]
+        if automated_only:
+            tensors = [d for d in tensors if d["creation_type"] == "automated"]
+        return records_from_dicts(tensors)
+
+    def read_tensor_file(self, fpath):
+        """Read in raw tensors from a file in either the JSON lines or the
+        binary tensor file format."""
+        if is_binary_tensor_file(fpath):
+            self.read_records(*read_records(fpath))
+        else:
+            with open(fpath) as fh:
+                self.read_raw_tensors(fh)
+
+    def write_binary_raw_tensors(self, fpath):
+        """Write out raw tensors to a file in the binary tensor file format."""
+        write_records(fpath, *self.records(automated_only=True))
+
     def write_audit_log(self, fh):
         """Write out an audit log."""
         for cmd in self.audit_log:
@@ -302,7 +674,9 @@ class TensorManager(dict):
         if action == "update":
             tensor_id = d.pop("tensor_id")
             for key, value in d.items():
-                self[tensor_id]._data[key] = value
+                self[tensor_id]._set(key, value)
+                self._index_value(tensor_id, key, value)
+            self._record_change(tensor_id)
         elif action == "create":
             tensor_id = d["tensor_id"]
             self[tensor_id] = Tensor.from_json(json.dumps(d))
@@ -315,26 +689,264 @@ class TensorManager(dict):
             self.apply_json(json_line)
 
 
+class TensorView(Tensor):
+    """Tensor reading from and writing to a row of TensorColumns."""
+
+    __slots__ = ("_columns", "_tensor_id")
+
+    def __init__(self, columns, tensor_id):
+        self._columns = columns
+        self._tensor_id = tensor_id
+
+    @property
+    def _data(self):
+        return dict((key, self._get(key)) for key in Tensor.keys())
+
+    def _get(self, name):
+        return self._columns.get(self._tensor_id, name)
+
+    def _set(self, name, value):
+        self._columns.set(self._tensor_id, name, value)
+
+
+class TensorColumns(object):
+    """Parallel numpy arrays holding the data of many tensors.
+
+    The rows are kept packed: deleting a tensor moves the last row into the
+    one that has been freed."""
+
+    array_names = ["tensor_ids", "centroids", "markers", "creation_types",
+                   "active", "integral"]
+
+    def __init__(self, capacity=1024):
+        self.tensor_ids = np.zeros(capacity, dtype=np.int64)
+        self.centroids = np.zeros((capacity, 2), dtype=np.float64)
+        self.markers = np.zeros((capacity, 2), dtype=np.float64)
+        self.creation_types = np.zeros(capacity, dtype=np.uint8)
+        self.active = np.zeros(capacity, dtype=bool)
+        # Which centroid and marker coordinates are integers rather than
+        # floats, so that they are output as they were given.
+        self.integral = np.zeros((capacity, 2, 2), dtype=bool)
+        self.creation_type_names = ["automated", "manual"]
+        self.rows = {}
+
+    def __len__(self):
+        return len(self.rows)
+
+    def _grow(self):
+        """Double the capacity of the arrays."""
+        for name in self.array_names:
+            array = getattr(self, name)
+            grown = np.zeros((2 * len(array),) + array.shape[1:],
+                             dtype=array.dtype)
+            grown[:len(array)] = array
+            setattr(self, name, grown)
+
+    def add(self, data):
+        """Add or replace the row of a tensor from a dictionary of its data."""
+        tensor_id = int(data["tensor_id"])
+        if tensor_id not in self.rows:
+            row = len(self.rows)
+            if row == len(self.tensor_ids):
+                self._grow()
+            self.rows[tensor_id] = row
+            self.tensor_ids[row] = tensor_id
+        for name in ["centroid", "marker", "creation_type", "active"]:
+            self.set(tensor_id, name, data[name])
+
+    def remove(self, tensor_id):
+        """Remove the row of a tensor."""
+        row = self.rows.pop(tensor_id)
+        last = len(self.rows)
+        if row != last:
+            for name in self.array_names:
+                array = getattr(self, name)
+                array[row] = array[last]
+            self.rows[int(self.tensor_ids[row])] = row
+
+    def get(self, tensor_id, name):
+        """Return a property of a tensor."""
+        row = self.rows[tensor_id]
+        if name == "tensor_id":
+            return int(self.tensor_ids[row])
+        elif name == "centroid":
+            return typed_values(self.centroids[row].tolist(),
+                                self.integral[row, 0])
+        elif name == "marker":
+            return typed_values(self.markers[row].tolist(),
+                                self.integral[row, 1])
+        elif name == "creation_type":
+            return self.creation_type_names[self.creation_types[row]]
+        elif name == "active":
+            return bool(self.active[row])
+        raise KeyError(name)
+
+    def set(self, tensor_id, name, value):
+        """Set a property of a tensor."""
+        row = self.rows[tensor_id]
+        if name == "centroid":
+            self.centroids[row] = value
+            self.integral[row, 0] = integral_flags(value)
+        elif name == "marker":
+            self.markers[row] = value
+            self.integral[row, 1] = integral_flags(value)
+        elif name == "creation_type":
+            if value not in self.creation_type_names:
+                self.creation_type_names.append(value)
+            self.creation_types[row] = self.creation_type_names.index(value)
+        elif name == "active":
+            self.active[row] = value
+        else:
+            raise KeyError(name)
+
+
+class ColumnarTensorManager(TensorManager):
+    """TensorManager storing the tensors in numpy arrays.
+
+    Looking up a tensor returns a TensorView of its row in the arrays, so
+    that very large numbers of tensors take up little memory."""
+
+    def __init__(self, cell_size=64, coalesce_window=None, max_history=None):
+        TensorManager.__init__(self, cell_size, coalesce_window, max_history)
+        self.columns = TensorColumns()
+
+    def __repr__(self):
+        return "<ColumnarTensorManager({} tensors)>".format(len(self))
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __len__(self):
+        return len(self.columns)
+
+    def __contains__(self, tensor_id):
+        return tensor_id in self.columns.rows
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __getitem__(self, tensor_id):
+        if tensor_id not in self.columns.rows:
+            raise KeyError(tensor_id)
+        return TensorView(self.columns, tensor_id)
+
+    def __setitem__(self, tensor_id, tensor):
+        self.columns.add(dict(tensor._data, tensor_id=tensor_id))
+        self._index_tensor(tensor_id)
+        self._record_change(tensor_id)
+
+    def __delitem__(self, tensor_id):
+        self.columns.remove(tensor_id)
+        self._unindex_tensor(tensor_id)
+        self._record_change(tensor_id)
+
+    def get(self, tensor_id, default=None):
+        if tensor_id in self:
+            return self[tensor_id]
+        return default
+
+    def pop(self, tensor_id, *default):
+        if tensor_id not in self:
+            if default:
+                return default[0]
+            raise KeyError(tensor_id)
+        # Copy the tensor out of the arrays before its row is freed.
+        tensor = Tensor.from_json(self[tensor_id].json)
+        del self[tensor_id]
+        return tensor
+
+    def copy(self):
+        return dict(self.items())
+
+    def keys(self):
+        return list(self.columns.rows)
+
+    def values(self):
+        return [self[tensor_id] for tensor_id in self.keys()]
+
+    def items(self):
+        return [(tensor_id, self[tensor_id]) for tensor_id in self.keys()]
+
+    @property
+    def identifiers(self):
+        """Return sorted list of identifiers."""
+        num_tensors = len(self.columns)
+        return np.sort(self.columns.tensor_ids[:num_tensors]).tolist()
+
+    def read_records(self, records, creation_type_names):
+        """Read in tensors from records of the binary tensor file format."""
+        columns = self.columns
+        codes = []
+        for name in creation_type_names:
+            if name not in columns.creation_type_names:
+                columns.creation_type_names.append(name)
+            codes.append(columns.creation_type_names.index(name))
+        codes = np.array(codes, dtype=np.uint8)
+        for tensor_id in records["tensor_id"]:
+            if int(tensor_id) in columns.rows:
+                del self[int(tensor_id)]
+        start = len(columns)
+        while len(columns.tensor_ids) < start + len(records):
+            columns._grow()
+        end = start + len(records)
+        columns.tensor_ids[start:end] = records["tensor_id"]
+        columns.centroids[start:end] = records["centroid"]
+        columns.markers[start:end] = records["marker"]
+        columns.creation_types[start:end] = codes[records["creation_type"]]
+        columns.active[start:end] = records["active"]
+        columns.integral[start:end] = records["integral"]
+        for row in range(start, end):
+            tensor_id = int(columns.tensor_ids[row])
+            columns.rows[tensor_id] = row
+            self._index_tensor(tensor_id)
+            self._record_change(tensor_id)
+
+    def records(self, automated_only=False):
+        """Return (records, creation type names) of the tensors in the binary
+        tensor file format."""
+        columns = self.columns
+        num_tensors = len(columns)
+        order = np.argsort(columns.tensor_ids[:num_tensors])
+        records = np.zeros(num_tensors, dtype=RECORD_DTYPE)
+        records["tensor_id"] = columns.tensor_ids[order]
+        records["centroid"] = columns.centroids[order]
+        records["marker"] = columns.markers[order]
+        records["creation_type"] = columns.creation_types[order]
+        records["active"] = columns.active[order]
+        records["integral"] = columns.integral[order]
+        if automated_only:
+            automated = columns.creation_type_names.index("automated")
+            records = records[records["creation_type"] == automated]
+        return records, list(columns.creation_type_names)
+
+
 def get_tensors(cells, markers):
-    """Return TensorManager instance."""
+    """Return TensorManager instance.
+
+    The marker convex hull centroids and the cell centroids are all
+    calculated up front, rather than selecting each region from the full
+    images in turn."""
     tensor_manager = TensorManager()
+    assignment = marker_cell_assignment(markers, cells)
+    marker_index = dict((marker_id, i)
+                        for i, marker_id in enumerate(assignment.marker_ids))
+    cell_centroids = region_centroids(cells)
     for tensor_id, marker_id in enumerate(markers.identifiers):
-        m_region = markers.region_by_identifier(marker_id)
-        marker_position = m_region.convex_hull.centroid
-        cell_id = marker_cell_identifier(m_region, cells)
+        i = marker_index[marker_id]
+        marker_position = tuple(assignment.centroids[i])
+        cell_id = assignment.cell_ids[i]
         if cell_id == 0:
             logging.debug("Skipping tensor from cell_id 0")
             continue
-        c_region = cells.region_by_identifier(cell_id)
-        centroid = c_region.centroid
+        centroid = cell_centroids[cell_id]
         tensor_manager.create_tensor(tensor_id, centroid, marker_position)
     return tensor_manager
 
 
-def test_overall_api():
+def test_overall_api(manager_class=TensorManager):
 
     # Test the creation of a tensor.
-    tensor_manager = TensorManager()
+    tensor_manager = manager_class()
     tensor_manager.create_tensor(1, (0, 0), (3, 5))
     tensor1 = tensor_manager[1]
     assert isinstance(tensor1, Tensor)
@@ -386,7 +998,8 @@ def test_overall_api():
     assert tensor_manager.identifiers == [1, 2, 5]
 
     # Test add_tensor undo/redo.
-    tensor_id = tensor_manager.add_tensor((3, 4), (5, 6))
+    tensor_manager.add_tensor((3, 4), (5, 6))
+    tensor_id = max(tensor_manager.identifiers)
     assert tensor_id == 6
     tensor = tensor_manager[tensor_id]
     assert tensor.tensor_id == tensor_id
@@ -437,7 +1050,7 @@ def test_overall_api():
     assert os.path.isfile(audit_file)
 
     # Test recreation from an audit file.
-    new_tensor_manager = TensorManager()
+    new_tensor_manager = manager_class()
     with open(raw_tensor_file, "r") as fh:
         new_tensor_manager.read_raw_tensors(fh)
     with open(audit_file) as fh:
@@ -453,6 +1066,167 @@ def test_overall_api():
     os.unlink(audit_file)
     os.unlink(raw_tensor_file)
 
+
+def test_columnar_tensor_manager():
+
+    # Test the editing api with the tensors stored in columns.
+    test_overall_api(ColumnarTensorManager)
+
+    # Create more tensors than the initial capacity of the columns, with
+    # integer and float coordinates, then delete some of them.
+    tensor_manager = TensorManager()
+    columnar = ColumnarTensorManager()
+    for manager in (tensor_manager, columnar):
+        for tensor_id in range(3000):
+            manager.create_tensor(tensor_id, (tensor_id * 1.5, 2),
+                                  (3, tensor_id * 0.5))
+        for tensor_id in range(0, 3000, 3):
+            manager._delete_tensor(tensor_id)
+        manager.inactivate_tensor(1)
+        manager.update_marker(2, (7.5, 8))
+
+    # Test that both store the same tensors, written out the same way.
+    assert tensor_manager == columnar and columnar == tensor_manager
+    assert columnar.identifiers == tensor_manager.identifiers
+    assert columnar[4].csv_line == "4,6.0,2,3,2.0,automated,True"
+    assert columnar.csv == tensor_manager.csv
+    assert (list(columnar.iter_csv(["tensor_id", "marker_row"], True)) ==
+            list(tensor_manager.iter_csv(["tensor_id", "marker_row"], True)))
+    records, names = columnar.records()
+    expected_records, expected_names = tensor_manager.records()
+    assert np.array_equal(records, expected_records)
+    assert names == expected_names
+    assert (columnar.query_box(0, 0, 300, 300, "marker") ==
+            tensor_manager.query_box(0, 0, 300, 300, "marker"))
+
+    # Test the dict methods, which keep the spatial indexes up to date.
+    tensor4 = columnar.pop(4)
+    assert tensor4 == tensor_manager.pop(4)
+    columnar.create_tensor(3000, (0, 0), (0, 0))
+    assert tensor4.centroid == [6.0, 2]
+    assert 4 not in columnar.query_box(0, 0, 10, 10)
+    assert columnar.pop(4, None) is None
+    tensor_manager.create_tensor(3000, (0, 0), (0, 0))
+    tensor = Tensor(4, (1, 1), (2, 2), "manual")
+    for manager in (tensor_manager, columnar):
+        manager.update({4: tensor})
+        assert manager.setdefault(4, None) == tensor
+        assert manager.query_box(0, 0, 1, 1) == [4, 3000]
+    assert columnar == tensor_manager
+    assert columnar.copy() == dict(tensor_manager.items())
+    columnar.clear()
+    assert len(columnar) == 0 and columnar.identifiers == []
+    assert columnar.query_box(0, 0, 10000, 10000) == []
+
+
+def test_change_feed():
+    tensor_manager = TensorManager()
+    for tensor_id in range(4):
+        tensor_manager.create_tensor(tensor_id, (tensor_id, 0), (0, tensor_id))
+    version = tensor_manager.version
+    assert tensor_manager.changes_since(version) == ([], [])
+
+    # Test edits, undo and redo.
+    tensor_manager.update_marker(1, (5, 5))
+    tensor_manager.add_tensor((1, 1), (2, 2))
+    tensor_manager.undo()
+    assert tensor_manager.changes_since(version) == ([1], [4])
+    assert tensor_manager.changes_since(0) == ([0, 1, 2, 3], [4])
+    redo_version = tensor_manager.version
+    tensor_manager.redo()
+    assert tensor_manager.changes_since(redo_version) == ([4], [])
+    assert tensor_manager.changes_since(version) == ([1, 4], [])
+
+    # Test batch edits, audit log lines and the dict methods.
+    version = tensor_manager.version
+    tensor_manager.inactivate_many([0, 2])
+    assert tensor_manager.changes_since(version) == ([0, 2], [])
+    version = tensor_manager.version
+    tensor_manager.apply_json(
+        '{"tensor_id": 3, "marker": [1, 1], "action": "update"}')
+    tensor_manager.pop(0)
+    tensor_manager.update({5: Tensor(5, (0, 0), (0, 0), "manual")})
+    assert tensor_manager.changes_since(version) == ([3, 5], [0])
+
+    # Test that a manager loaded afresh starts a new epoch.
+    assert TensorManager().epoch != tensor_manager.epoch
+
+
+def test_apply_batch():
+    tensor_manager = TensorManager()
+    for tensor_id in range(4):
+        tensor_manager.create_tensor(tensor_id, (tensor_id * 10, 0),
+                                     (tensor_id * 10, 5))
+    original = [tensor_manager[i].json for i in tensor_manager.identifiers]
+
+    # Test a batch, undone and redone as a single command.
+    tensor_manager.apply_batch([dict(tensor_id=0, centroid=(1, 2),
+                                     active=False),
+                                dict(tensor_id=1, marker=[5.5, 6])])
+    assert len(tensor_manager.commands) == 1
+    assert tensor_manager[0].centroid == [1, 2]
+    assert tensor_manager[0].active is False
+    assert tensor_manager[1].marker == [5.5, 6]
+    assert tensor_manager.query_box(1, 1, 2, 2) == [0]
+    tensor_manager.undo()
+    assert [tensor_manager[i].json
+            for i in tensor_manager.identifiers] == original
+    assert tensor_manager.query_box(1, 1, 2, 2) == []
+    tensor_manager.redo()
+    assert tensor_manager[0].centroid == [1, 2]
+
+    # Test updating the same tensor twice in a batch.
+    tensor_manager.apply_batch([dict(tensor_id=2, marker=(1, 1)),
+                                dict(tensor_id=2, marker=(2, 2))])
+    assert tensor_manager[2].marker == [2, 2]
+    tensor_manager.undo()
+    assert tensor_manager[2].marker == [20, 5]
+
+    # Test that invalid batches leave the tensors and the history untouched.
+    before = [tensor_manager[i].json for i in tensor_manager.identifiers]
+    num_commands = len(tensor_manager.commands)
+    for updates in ([dict(tensor_id=3, centroid=(1,))],
+                    [dict(tensor_id=3, centroid=(float("nan"), 1))],
+                    [dict(tensor_id=3, marker=(True, 1))],
+                    [dict(tensor_id=3, active="no")],
+                    [dict(tensor_id=3, creation_type="manual")],
+                    [dict(tensor_id=3, marker=(1, 1)),
+                     dict(tensor_id=99, marker=(1, 1))]):
+        try:
+            tensor_manager.apply_batch(updates)
+        except (KeyError, ValueError):
+            pass
+        else:
+            assert False, "Invalid batch applied: {}".format(updates)
+    assert [tensor_manager[i].json
+            for i in tensor_manager.identifiers] == before
+    assert len(tensor_manager.commands) == num_commands
+    assert tensor_manager.command_offset == -1
+    assert tensor_manager.apply_batch([]) is None
+
+    # Test inactivating the tensors inside a polygon.
+    triangle = [(-1, -1), (-1, 25), (25, -1)]
+    assert tensor_manager.tensors_in_polygon(triangle) == [0, 1, 2]
+    assert tensor_manager.tensors_in_polygon(triangle, "marker") == [0, 1]
+    tensor_manager.inactivate_many(tensor_manager.tensors_in_polygon(triangle))
+    assert [tensor_manager[i].active for i in range(4)] == [False, False,
+                                                           False, True]
+    assert tensor_manager.tensors_in_polygon(triangle, active_only=True) == []
+    for polygon in ([], [(1,)], [(0, 0), (1, 1)], [(0, 0), ("a", 1), (3, 3)],
+                    [(0, 0), (0, float("inf")), (5, 5)]):
+        try:
+            tensor_manager.tensors_in_polygon(polygon)
+        except ValueError:
+            pass
+        else:
+            assert False, "Invalid polygon accepted: {}".format(polygon)
+    tensor_manager.undo()
+    assert tensor_manager[1].active is True
+
+
 if __name__ == "__main__":
     logging.basicConfig(level=logging.DEBUG)
     test_overall_api()
+    test_columnar_tensor_manager()
+    test_change_feed()
+    test_apply_batch()
@@ -0,0 +1,216 @@
+"""Module for storing tensors in a compact binary file format.
+
+A binary tensor file starts with a magic string, the format version and a
+JSON header. The tensors follow as fixed-width records in the .npy format,
+so that they can be memory-mapped rather than parsed.
+
+Files can be converted to and from the JSON lines format of
+raw_tensors.txt:
+
+    python tensorfile.py raw_tensors.txt raw_tensors.bin
+"""
+
+import os.path
+import json
+import shutil
+import struct
+import argparse
+import tempfile
+from collections import OrderedDict
+
+import numpy as np
+
+RAW_TENSORS_BINARY_FNAME = "raw_tensors.bin"
+
+MAGIC = b"\x93TENSORS"
+FORMAT_VERSION = 2
+# The integral flags record which centroid and marker coordinates were
+# integers, so that they are read back as integers rather than floats.
+RECORD_DTYPE = np.dtype([("tensor_id", "<i8"),
+                         ("centroid", "<f8", (2,)),
+                         ("marker", "<f8", (2,)),
+                         ("creation_type", "u1"),
+                         ("active", "?"),
+                         ("integral", "?", (2, 2))])
+
+
+def integral_flags(values):
+    """Return list of flags, True for the values that are integers."""
+    return [not isinstance(v, (float, np.floating)) for v in values]
+
+
+def typed_values(values, integral):
+    """Return list of float values, as integers where flagged integral."""
+    return [int(v) if is_integral else float(v)
+            for v, is_integral in zip(values, integral)]
+
+
+def is_binary_tensor_file(fpath):
+    """Return True if the file is in the binary tensor format."""
+    with open(fpath, "rb") as fh:
+        return fh.read(len(MAGIC)) == MAGIC
+
+
+def write_records(fpath, records, creation_type_names):
+    """Write tensor records to a binary tensor file."""
+    header = json.dumps(dict(creation_type_names=creation_type_names))
+    header = header.encode("utf-8")
+    with open(fpath, "wb") as fh:
+        fh.write(MAGIC)
+        fh.write(struct.pack("<BI", FORMAT_VERSION, len(header)))
+        fh.write(header)
+        np.lib.format.write_array(fh, np.asarray(records, dtype=RECORD_DTYPE))
+
+
+def read_records(fpath, mmap_mode="r"):
+    """Return (records, creation type names) from a binary tensor file.
+
+    The records are memory-mapped unless mmap_mode is None."""
+    with open(fpath, "rb") as fh:
+        if fh.read(len(MAGIC)) != MAGIC:
+            raise ValueError("Not a binary tensor file: {}".format(fpath))
+        version, header_length = struct.unpack("<BI", fh.read(5))
+        if version not in (1, FORMAT_VERSION):
+            raise ValueError("Unsupported tensor file version {} in {}".format(
+                version, fpath))
+        header = json.loads(fh.read(header_length).decode("utf-8"))
+        npy_version = np.lib.format.read_magic(fh)
+        if npy_version == (1, 0):
+            shape, fortran_order, dtype = \
+                np.lib.format.read_array_header_1_0(fh)
+        else:
+            shape, fortran_order, dtype = \
+                np.lib.format.read_array_header_2_0(fh)
+        offset = fh.tell()
+        if mmap_mode is None or shape[0] == 0:
+            records = np.fromfile(fh, dtype=dtype, count=shape[0])
+        else:
+            records = np.memmap(fpath, dtype=dtype, mode=mmap_mode,
+                                shape=shape, offset=offset)
+    if version == 1:
+        # Version 1 files have no integral flags; all coordinates are floats.
+        upgraded = np.zeros(len(records), dtype=RECORD_DTYPE)
+        for name in dtype.names:
+            upgraded[name] = records[name]
+        records = upgraded
+    return records, header["creation_type_names"]
+
+
+def records_from_dicts(dicts):
+    """Return (records, creation type names) from tensor dictionaries."""
+    dicts = list(dicts)
+    creation_type_names = ["automated", "manual"]
+    for d in dicts:
+        if d["creation_type"] not in creation_type_names:
+            creation_type_names.append(d["creation_type"])
+    codes = dict((name, i) for i, name in enumerate(creation_type_names))
+    records = np.zeros(len(dicts), dtype=RECORD_DTYPE)
+    if dicts:
+        # Fill a field at a time rather than a record at a time.
+        records["tensor_id"] = [d["tensor_id"] for d in dicts]
+        records["centroid"] = [d["centroid"] for d in dicts]
+        records["marker"] = [d["marker"] for d in dicts]
+        records["creation_type"] = [codes[d["creation_type"]] for d in dicts]
+        records["active"] = [d["active"] for d in dicts]
+        records["integral"] = [[integral_flags(d["centroid"]),
+                                integral_flags(d["marker"])] for d in dicts]
+    return records, creation_type_names
+
+
+def dicts_from_records(records, creation_type_names):
+    """Yield tensor dictionaries, in the key order of Tensor.json."""
+    for record in records:
+        yield OrderedDict([
+            ("tensor_id", int(record["tensor_id"])),
+            ("centroid", typed_values(record["centroid"].tolist(),
+                                      record["integral"][0])),
+            ("marker", typed_values(record["marker"].tolist(),
+                                    record["integral"][1])),
+            ("creation_type", creation_type_names[record["creation_type"]]),
+            ("active", bool(record["active"]))])
+
+
+def jsonl_to_binary(jsonl_fpath, binary_fpath):
+    """Convert a JSON lines tensor file to the binary format."""
+    with open(jsonl_fpath) as fh:
+        dicts = [json.loads(line) for line in fh if line.strip()]
+    records, creation_type_names = records_from_dicts(dicts)
+    write_records(binary_fpath, records, creation_type_names)
+
+
+def binary_to_jsonl(binary_fpath, jsonl_fpath):
+    """Convert a binary tensor file to the JSON lines format."""
+    records, creation_type_names = read_records(binary_fpath)
+    with open(jsonl_fpath, "w") as fh:
+        for d in dicts_from_records(records, creation_type_names):
+            fh.write("{}\n".format(json.dumps(d)))
+
+
+def test_round_trip():
+    directory = tempfile.mkdtemp()
+    jsonl_fpath = os.path.join(directory, "raw_tensors.txt")
+    binary_fpath = os.path.join(directory, "raw_tensors.bin")
+    copy_fpath = os.path.join(directory, "copy.txt")
+    v1_fpath = os.path.join(directory, "version1.bin")
+
+    # Integer and float coordinates, and a creation type of its own.
+    lines = [
+        '{"tensor_id": 0, "centroid": [1, 2], "marker": [3.5, 4], '
+        '"creation_type": "automated", "active": true}',
+        '{"tensor_id": 7, "centroid": [1.0, 0.25], "marker": [-3, 4.0], '
+        '"creation_type": "manual", "active": false}',
+        '{"tensor_id": 8, "centroid": [10, 20], "marker": [30, 40], '
+        '"creation_type": "imported", "active": true}']
+    with open(jsonl_fpath, "w") as fh:
+        fh.write("\n".join(lines) + "\n")
+
+    # Test that the conversion round trip gives back the same file.
+    jsonl_to_binary(jsonl_fpath, binary_fpath)
+    assert is_binary_tensor_file(binary_fpath)
+    assert not is_binary_tensor_file(jsonl_fpath)
+    binary_to_jsonl(binary_fpath, copy_fpath)
+    with open(copy_fpath) as fh:
+        assert fh.read().splitlines() == lines
+
+    # Test reading the records with and without memory-mapping.
+    records, creation_type_names = read_records(binary_fpath)
+    assert creation_type_names == ["automated", "manual", "imported"]
+    in_memory, _ = read_records(binary_fpath, mmap_mode=None)
+    assert np.array_equal(records, in_memory)
+    assert list(records["tensor_id"]) == [0, 7, 8]
+    assert list(records["active"]) == [True, False, True]
+
+    # Test reading a version 1 file, which has no integral flags.
+    v1_dtype = np.dtype([(name, RECORD_DTYPE.fields[name][0])
+                         for name in RECORD_DTYPE.names
+                         if name != "integral"])
+    header = json.dumps(dict(creation_type_names=creation_type_names))
+    header = header.encode("utf-8")
+    with open(v1_fpath, "wb") as fh:
+        fh.write(MAGIC)
+        fh.write(struct.pack("<BI", 1, len(header)))
+        fh.write(header)
+        np.lib.format.write_array(fh, in_memory[list(v1_dtype.names)]
+                                  .astype(v1_dtype))
+    dicts = list(dicts_from_records(*read_records(v1_fpath)))
+    assert dicts[0]["centroid"] == [1.0, 2.0]
+    assert isinstance(dicts[0]["centroid"][0], float)
+    assert dicts[1]["creation_type"] == "manual"
+
+    shutil.rmtree(directory)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("input_file", help="JSON lines or binary tensor file")
+    parser.add_argument("output_file", help="converted tensor file")
+    args = parser.parse_args()
+
+    if is_binary_tensor_file(args.input_file):
+        binary_to_jsonl(args.input_file, args.output_file)
+    else:
+        jsonl_to_binary(args.input_file, args.output_file)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+"""Module for building tile pyramids of the images shown in the editor.
+
+Each image is cut into square tiles at a number of zoom levels, halving the
+resolution from one level to the next, so that the editor only needs to
+fetch the tiles in view at a resolution matching the zoom.
+
+    tiles/<layer>/manifest.json
+    tiles/<layer>/<level>/<row>_<col>.png
+"""
+
+import os
+import os.path
+import json
+import shutil
+import hashlib
+import argparse
+import logging
+
+import PIL.Image
+
+TILES_DIRNAME = "tiles"
+TILE_SIZE = 256
+MANIFEST_FNAME = "manifest.json"
+
+# Segmentations are downsampled without mixing the colours of the regions.
+LAYERS = dict(wall_intensity=PIL.Image.BILINEAR,
+              marker_intensity=PIL.Image.BILINEAR,
+              segmentation=PIL.Image.NEAREST)
+
+
+def _md5(fpath):
+    with open(fpath, "rb") as fh:
+        return hashlib.md5(fh.read()).hexdigest()
+
+
+def tile_fname(level, row, col):
+    """Return path of a tile relative to the directory of its layer."""
+    return os.path.join(str(level), "{:d}_{:d}.png".format(row, col))
+
+
+def tile_fpath(layer_dir, level, row, col):
+    """Return path of a tile."""
+    return os.path.join(layer_dir, tile_fname(level, row, col))
+
+
+def read_manifest(layer_dir):
+    """Return the manifest of a tile pyramid, or None if there is none."""
+    fpath = os.path.join(layer_dir, MANIFEST_FNAME)
+    if not os.path.isfile(fpath):
+        return None
+    with open(fpath) as fh:
+        return json.load(fh)
+
+
+def build_pyramid(image_fpath, layer_dir, tile_size=TILE_SIZE,
+                  resample=PIL.Image.BILINEAR):
+    """Build tile pyramid of an image and return its manifest.
+
+    Level 0 is the full resolution image; levels are added until the whole
+    image fits in a single tile."""
+    if os.path.isdir(layer_dir):
+        shutil.rmtree(layer_dir)
+    image = PIL.Image.open(image_fpath)
+    if image.mode == "P":
+        image = image.convert("RGBA")
+    levels = []
+    level = 0
+    while True:
+        width, height = image.size
+        rows = (height + tile_size - 1) // tile_size
+        cols = (width + tile_size - 1) // tile_size
+        os.makedirs(os.path.join(layer_dir, str(level)))
+        for row in range(rows):
+            for col in range(cols):
+                box = (col * tile_size, row * tile_size,
+                       min((col + 1) * tile_size, width),
+                       min((row + 1) * tile_size, height))
+                tile = image.crop(box)
+                tile.save(tile_fpath(layer_dir, level, row, col))
+        levels.append(dict(width=width, height=height, rows=rows, cols=cols))
+        if rows == 1 and cols == 1:
+            break
+        image = image.resize((max(1, (width + 1) // 2),
+                              max(1, (height + 1) // 2)), resample)
+        level += 1
+
+    manifest = dict(tile_size=tile_size,
+                    levels=levels,
+                    version=_md5(image_fpath)[:12])
+    # The manifest is written last, so that it marks a complete pyramid.
+    with open(os.path.join(layer_dir, MANIFEST_FNAME), "w") as fh:
+        json.dump(manifest, fh)
+    logging.debug("Built {} tile levels of {}".format(len(levels),
+                                                      image_fpath))
+    return manifest
+
+
+def build_tiles(input_dir, tile_size=TILE_SIZE):
+    """Build the tile pyramids of the editor images in input_dir that are
+    missing or out of date; return dictionary of manifests by layer."""
+    manifests = {}
+    for layer, resample in LAYERS.items():
+        image_fpath = os.path.join(input_dir, layer + ".png")
+        layer_dir = os.path.join(input_dir, TILES_DIRNAME, layer)
+        manifest = read_manifest(layer_dir)
+        if (manifest is None or manifest["tile_size"] != tile_size
+                or manifest["version"] != _md5(image_fpath)[:12]):
+            manifest = build_pyramid(image_fpath, layer_dir, tile_size,
+                                     resample)
+        manifests[layer] = manifest
+    return manifests
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("input_dir", help="analysis output directory")
+    parser.add_argument("-t", "--tile-size", type=int, default=TILE_SIZE,
+                        help="tile size in pixels")
+    args = parser.parse_args()
+    build_tiles(args.input_dir, args.tile_size)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,14 +1,19 @@
 """Utility functions."""
 
+import os
 import os.path
+import json
+import hashlib
 import logging
+import tempfile
+from collections import namedtuple
+from multiprocessing.pool import ThreadPool
 
 import numpy as np
 
 from jicbioimage.core.image import MicroscopyCollection
 from jicbioimage.core.transform import transformation
 from jicbioimage.core.io import (
-    AutoWrite,
     FileBackend,
     DataManager,
     _md5_hexdigest_from_file,
@@ -20,47 +25,185 @@ from jicbioimage.transform import (
     remove_small_objects,
 )
 
+from autoio import auto_io
+from regions import convex_hull_centroid, region_slices
+
 HERE = os.path.dirname(os.path.realpath(__file__))
 
+# Directory in the backend mapping input files to their md5 digests.
+INDEX_DIRNAME = "index"
 
-def get_data_manager():
-    """Return a data manager."""
+
+def get_backend_dir():
+    """Return the directory of the unpacked data backend."""
     data_dir = os.path.abspath(os.path.join(HERE, "..", "data"))
     if not os.path.isdir(data_dir):
         raise(OSError("Data directory does not exist: {}".format(data_dir)))
-    backend_dir = os.path.join(data_dir, 'unpacked')
+    return os.path.join(data_dir, 'unpacked')
+
+
+def get_data_manager():
+    """Return a data manager."""
+    backend_dir = get_backend_dir()
     file_backend = FileBackend(backend_dir)
     return DataManager(file_backend), backend_dir
 
 
-def get_microscopy_collection_from_tiff(input_file):
-    """Return microscopy collection from tiff file."""
+def _index_entry_path(backend_dir, key):
+    """Return path of the index file for the input file key."""
+    digest = hashlib.md5(json.dumps(key).encode("utf-8")).hexdigest()
+    return os.path.join(backend_dir, INDEX_DIRNAME, digest + ".json")
+
+
+def _input_file_key(input_file):
+    """Return list identifying the input file without reading it."""
+    fpath = os.path.abspath(input_file)
+    stat = os.stat(fpath)
+    return [fpath, stat.st_size, stat.st_mtime, stat.st_ino]
+
+
+def md5_from_index(backend_dir, input_file):
+    """Return the md5 of the input file recorded in the backend index.
+
+    Returns None if the file is not in the index, or if it has been modified
+    since it was indexed."""
+    key = _input_file_key(input_file)
+    try:
+        with open(_index_entry_path(backend_dir, key)) as fh:
+            entry = json.load(fh)
+    except (IOError, OSError, ValueError):
+        return None
+    if entry.get("key") != key:
+        return None
+    return entry["md5_hexdigest"]
+
+
+def add_to_index(backend_dir, input_file, md5_hex):
+    """Record the md5 of the input file in the backend index.
+
+    Each entry is written to a temporary file and renamed into place, so
+    processes sharing the backend never read a partially written entry."""
+    key = _input_file_key(input_file)
+    index_dir = os.path.join(backend_dir, INDEX_DIRNAME)
+    if not os.path.isdir(index_dir):
+        try:
+            os.makedirs(index_dir)
+        except OSError:
+            # Another process created it first.
+            if not os.path.isdir(index_dir):
+                raise
+    fd, tmp_fpath = tempfile.mkstemp(suffix=".tmp", dir=index_dir)
+    with os.fdopen(fd, "w") as fh:
+        json.dump(dict(key=key, md5_hexdigest=md5_hex), fh)
+    os.rename(tmp_fpath, _index_entry_path(backend_dir, key))
+
+
+def get_input_md5(input_file):
+    """Return md5 hex digest identifying the contents of the input file.
+
+    The file is only read if it is not in the backend index."""
+    backend_dir = get_backend_dir()
+    md5_hex = md5_from_index(backend_dir, input_file)
+    if md5_hex is None:
+        md5_hex = _md5_hexdigest_from_file(input_file)
+        if os.path.isdir(backend_dir):
+            add_to_index(backend_dir, input_file, md5_hex)
+    return md5_hex
+
+
+def get_manifest_path(input_file):
+    """Return path to the manifest of the unpacked input file.
+
+    The input file is only unpacked if it is not already in the backend."""
     data_manager, backend_dir = get_data_manager()
-    data_manager.load(input_file)
-
-    md5_hex = _md5_hexdigest_from_file(input_file)
+    md5_hex = get_input_md5(input_file)
     manifest_path = os.path.join(backend_dir, md5_hex, "manifest.json")
-
-    microscopy_collection = MicroscopyCollection()
+    if not os.path.isfile(manifest_path):
+        manifest_path = data_manager.convert(input_file)
+    return manifest_path
+
+
+class MemmapMicroscopyCollection(MicroscopyCollection):
+    """Microscopy collection serving z-stacks as read only memory maps.
+
+    The first time a z-stack is requested it is written, one z-slice at a
+    time, as a contiguous .npy file in the directory of the unpacked entry.
+    Later requests, including those from other runs, memory-map that file
+    instead of decoding every z-slice again."""
+
+    def __init__(self, directory):
+        MicroscopyCollection.__init__(self)
+        self.directory = directory
+
+    def zstack_fpath(self, s=0, c=0, t=0):
+        """Return path of the .npy file storing a z-stack."""
+        fname = "zstack_S{}_C{}_T{}.npy".format(s, c, t)
+        return os.path.join(self.directory, fname)
+
+    def write_zstack(self, s=0, c=0, t=0):
+        """Write a z-stack to its .npy file."""
+        proxy_images = list(self.zstack_proxy_iterator(s=s, c=c, t=t))
+        first = proxy_images[0].image
+        shape = first.shape + (len(proxy_images),)
+        fd, tmp_fpath = tempfile.mkstemp(suffix=".tmp", dir=self.directory)
+        os.close(fd)
+        try:
+            zstack = np.lib.format.open_memmap(tmp_fpath, mode="w+",
+                                               dtype=first.dtype, shape=shape)
+            zstack[:, :, 0] = first
+            for i, proxy_image in enumerate(proxy_images[1:], 1):
+                zstack[:, :, i] = proxy_image.image
+            zstack.flush()
+            del zstack
+        except BaseException:
+            # Do not leave a partly written z-stack behind.
+            os.unlink(tmp_fpath)
+            raise
+        # Renaming makes the file appear atomically to other processes.
+        os.rename(tmp_fpath, self.zstack_fpath(s=s, c=c, t=t))
+
+    def zstack_array(self, s=0, c=0, t=0):
+        """Return zstack as a read only memory-mapped :class:`numpy.ndarray`.
+        """
+        fpath = self.zstack_fpath(s=s, c=c, t=t)
+        if not os.path.isfile(fpath):
+            logging.debug("Writing z-stack to {}".format(fpath))
+            self.write_zstack(s=s, c=c, t=t)
+        return np.load(fpath, mmap_mode="r")
+
+
+def _microscopy_collection_from_manifest(manifest_path, memmap_zstacks):
+    """Return microscopy collection parsed from the manifest."""
+    if memmap_zstacks:
+        directory = os.path.dirname(manifest_path)
+        microscopy_collection = MemmapMicroscopyCollection(directory)
+    else:
+        microscopy_collection = MicroscopyCollection()
     microscopy_collection.parse_manifest(manifest_path)
     return microscopy_collection
 
 
-def get_microscopy_collection_from_org(input_file):
+def get_microscopy_collection_from_tiff(input_file, memmap_zstacks=False):
+    """Return microscopy collection from tiff file."""
+    manifest_path = get_manifest_path(input_file)
+    return _microscopy_collection_from_manifest(manifest_path, memmap_zstacks)
+
+
+def get_microscopy_collection_from_org(input_file, memmap_zstacks=False):
     """Return microscopy collection from microscopy file."""
-    data_manager, _ = get_data_manager()
-    return data_manager.load(input_file)
+    manifest_path = get_manifest_path(input_file)
+    return _microscopy_collection_from_manifest(manifest_path, memmap_zstacks)
 
 
-def get_microscopy_collection(input_file):
+def get_microscopy_collection(input_file, memmap_zstacks=False):
     name, ext = os.path.splitext(input_file)
     ext = ext.lower()
     if ext == '.tif' or ext == '.tiff':
         logging.debug("reading in a tif file")
-        return get_microscopy_collection_from_tiff(input_file)
+        return get_microscopy_collection_from_tiff(input_file, memmap_zstacks)
     else:
         logging.debug("reading in a microscopy file")
-        return get_microscopy_collection_from_org(input_file)
+        return get_microscopy_collection_from_org(input_file, memmap_zstacks)
 
 
 @transformation
@@ -76,11 +219,9 @@ def threshold_abs(image, threshold):
 
 @transformation
 def mask_from_large_objects(image, max_size):
-    tmp_autowrite = AutoWrite.on
-    AutoWrite.on = False
-    mask = remove_small_objects(image, min_size=max_size)
-    mask = invert(mask)
-    AutoWrite.on = tmp_autowrite
+    with auto_io(on=False):
+        mask = remove_small_objects(image, min_size=max_size)
+        mask = invert(mask)
     return mask
 
 
@@ -100,45 +241,140 @@ def test_remove_large_objects():
 
 @transformation
 def remove_large_segments(segmentation, max_size):
-    for i in segmentation.identifiers:
-        region = segmentation.region_by_identifier(i)
-        if region.area > max_size:
-            segmentation[region] = 0
+    """Remove segments with an area larger than max_size.
+
+    The areas of all segments are counted in a single pass with a label
+    histogram, and the oversized segments are zeroed using a lookup table."""
+    labels = np.asarray(segmentation).astype(np.intp, copy=False)
+    if labels.size and labels.min() < 0:
+        raise(ValueError("Identifier must be a positive integer."))
+    areas = np.bincount(labels.ravel(), minlength=1)
+    too_large = areas > max_size
+    too_large[0] = False
+    segmentation[too_large[labels]] = 0
     return segmentation
 
 
 def segment_zslice(image):
-    """Segment a zslice."""
-    tmp_autowrite = AutoWrite.on
-    AutoWrite.on = False
-    image = identity(image)
-    image = threshold_abs(image, 100)
-    image = remove_small_objects(image, min_size=500)
-    AutoWrite.on = tmp_autowrite
+    """Segment a zslice.
+
+    Auto-writing is turned off for the current context only, so several
+    z-slices can be segmented at once in threads."""
+    with auto_io(on=False):
+        image = identity(image)
+        image = threshold_abs(image, 100)
+        image = remove_small_objects(image, min_size=500)
     return image
 
 
-def preprocess_zstack(zstack_proxy_iterator, cutoff):
+def _load_and_segment_zslice(proxy_image):
+    """Return (image, segmented) tuple for a z-slice proxy image."""
+    image = proxy_image.image
+    return image, segment_zslice(image)
+
+
+def _iter_segmented_zslices(proxy_images, workers):
+    """Yield (image, segmented) tuples in z order.
+
+    If workers is greater than one the z-slices are loaded and segmented in
+    a pool of threads; the scikit-image and NumPy kernels release the GIL for
+    much of that work."""
+    if workers is None or workers <= 1:
+        for proxy_image in proxy_images:
+            yield _load_and_segment_zslice(proxy_image)
+        return
+    pool = ThreadPool(workers)
+    try:
+        for result in pool.imap(_load_and_segment_zslice, proxy_images):
+            yield result
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def _accumulated_max_intensity_projection(image):
+    """Return the maximum intensity projection accumulated slice by slice.
+
+    Used to record the projection in the image history, and to auto-write it,
+    in the same way as max_intensity_projection."""
+    return image
+
+
+# Record and auto-write the projection under the name of the transformation
+# it replaces, so that the debug images keep their names.
+_accumulated_max_intensity_projection.__name__ = "max_intensity_projection"
+running_max_intensity_projection = transformation(
+    _accumulated_max_intensity_projection)
+
+
+def _new_zstack_array(shape, dtype, spill_dir):
+    """Return empty 3D array, memory-mapped in spill_dir if given."""
+    if spill_dir is None:
+        return np.empty(shape, dtype=dtype)
+    fd, fpath = tempfile.mkstemp(suffix=".npy", dir=spill_dir)
+    os.close(fd)
+    return np.lib.format.open_memmap(fpath, mode="w+",
+                                     dtype=dtype, shape=shape)
+
+
+def preprocess_zstack_streaming(zstack_proxy_iterator, keep_intensity3D=False,
+                                keep_mask3D=False, spill_dir=None,
+                                workers=None):
+    """Return (intensity2D, intensity3D, mask2D, mask3D) tuple.
+
+    The z-slices are read and segmented one at a time, and the maximum
+    intensity projections are accumulated as they go. The 3D arrays are only
+    built if asked for, otherwise they are None. If spill_dir is given the
+    3D arrays are memory-mapped .npy files in that directory, which the
+    caller is responsible for removing. If workers is given the z-slices
+    are segmented concurrently in that many threads."""
+    proxy_images = list(zstack_proxy_iterator)
+    zslices = _iter_segmented_zslices(proxy_images, workers)
+    intensity2D, intensity3D, mask2D, mask3D = None, None, None, None
+    for i, (image, segmented) in enumerate(zslices):
+        if i == 0:
+            intensity2D = np.array(image)
+            mask2D = np.array(segmented)
+            shape = image.shape + (len(proxy_images),)
+            if keep_intensity3D:
+                intensity3D = _new_zstack_array(shape, image.dtype, spill_dir)
+            if keep_mask3D:
+                mask3D = _new_zstack_array(shape, segmented.dtype, spill_dir)
+        else:
+            np.maximum(intensity2D, image, out=intensity2D)
+            np.maximum(mask2D, segmented, out=mask2D)
+        if intensity3D is not None:
+            intensity3D[:, :, i] = image
+        if mask3D is not None:
+            mask3D[:, :, i] = segmented
+    intensity2D = running_max_intensity_projection(intensity2D)
+    mask2D = running_max_intensity_projection(mask2D)
+    return intensity2D, intensity3D, mask2D, mask3D
+
+
+def preprocess_zstack(zstack_proxy_iterator, cutoff, workers=None):
     """Select the pixels where the signal is."""
-    raw = []
-    zstack = []
-    for i, proxy_image in enumerate(zstack_proxy_iterator):
-        image = proxy_image.image
-        segmented = segment_zslice(image)
-        raw.append(image)
-        zstack.append(segmented)
-    return np.dstack(raw), np.dstack(zstack)
+    _, raw, _, zstack = preprocess_zstack_streaming(zstack_proxy_iterator,
+                                                    keep_intensity3D=True,
+                                                    keep_mask3D=True,
+                                                    workers=workers)
+    return raw, zstack
 
 
-def get_wall_intensity_and_mask_images(microscopy_collection, channel):
+def get_wall_intensity_and_mask_images(microscopy_collection, channel,
+                                       keep_intensity3D=True, keep_mask3D=True,
+                                       spill_dir=None, workers=None):
     """
     Return (wall_intensity2D, wall_intensity3D, wall_mask2D, wall_mask3D).
+
+    The 3D images are None unless asked for.
     """
     wall_ziter = microscopy_collection.zstack_proxy_iterator(c=channel)
-    wall_intensity3D, wall_mask3D = preprocess_zstack(wall_ziter, 90)
-    wall_intensity2D = max_intensity_projection(wall_intensity3D)
-    wall_mask2D = max_intensity_projection(wall_mask3D)
-    return wall_intensity2D, wall_intensity3D, wall_mask2D, wall_mask3D
+    return preprocess_zstack_streaming(wall_ziter,
+                                       keep_intensity3D=keep_intensity3D,
+                                       keep_mask3D=keep_mask3D,
+                                       spill_dir=spill_dir,
+                                       workers=workers)
 
 
 def get_marker_intensity_images(microscopy_collection, channel):
@@ -152,3 +388,35 @@ def marker_cell_identifier(marker_region, cells):
     """Return cell identifier of marker region."""
     pos = marker_region.convex_hull.centroid
     return cells[pos]
+
+
+MarkerCellAssignment = namedtuple("MarkerCellAssignment",
+                                  ["marker_ids", "centroids", "cell_ids",
+                                   "overlaps"])
+
+
+def marker_cell_assignment(markers, cells, overlap=False):
+    """Return MarkerCellAssignment for all markers at once.
+
+    The result holds arrays of marker identifiers (sorted), convex hull
+    centroids of the markers, the identifiers of the cells the centroids fall
+    in and, if overlap is True, the fraction of each marker that lies in
+    that cell.
+
+    Each marker is visited once, on a patch cropped to its bounding box; the
+    overlap is measured on the same patch as the convex hull."""
+    marker_labels = np.asarray(markers)
+    cell_labels = np.asarray(cells)
+    slices = region_slices(marker_labels)
+    marker_ids = np.array(sorted(slices), dtype=np.intp)
+    centroids = np.zeros((len(marker_ids), 2), dtype=np.float64)
+    cell_ids = np.zeros(len(marker_ids), dtype=cell_labels.dtype)
+    overlaps = np.zeros(len(marker_ids)) if overlap else None
+    for i, marker_id in enumerate(marker_ids):
+        slc = slices[marker_id]
+        patch = marker_labels[slc] == marker_id
+        centroids[i] = convex_hull_centroid(patch, slc)
+        cell_ids[i] = cell_labels[int(centroids[i, 0]), int(centroids[i, 1])]
+        if overlap:
+            overlaps[i] = np.mean(cell_labels[slc][patch] == cell_ids[i])
+    return MarkerCellAssignment(marker_ids, centroids, cell_ids, overlaps)
@@ -1,147 +1,278 @@
-"""Basic webapp for editing tensors."""
+"""Basic webapp for editing tensors.
+
+The webapp serves any number of datasets, each an analysis output directory.
+A dataset is loaded on first access; only a bounded number are kept loaded,
+evicting the least recently used one and flushing its audit log.
+"""
 
 import os.path
+import json
 import argparse
-import shutil
-import base64
-
-import PIL
-from flask import Flask, render_template, url_for, request
-from tensor import TensorManager
-
+import functools
+
+from flask import (
+    Flask,
+    Response,
+    abort,
+    jsonify,
+    render_template,
+    request,
+    send_from_directory,
+)
+from tensor import TensorManager, ColumnarTensorManager
+from datasets import DatasetRegistry
+
+from tiles import LAYERS, TILES_DIRNAME, tile_fname
 from utils import HERE
 
 STATIC = os.path.join(HERE, "static")
 
 app = Flask(__name__)
 
-AUDIT_LOG_FNAME = "audit.log"
 
+# Tile routes include the version of their pyramid, and only serve the
+# current version, so the tiles can be cached for long.
+TILE_MAX_AGE = 7 * 24 * 60 * 60
 
-def base64_from_fpath(fpath):
-    """Return base64 string from fpath."""
-    return base64.b64encode(open(fpath, "rb").read())
 
-
-def write_audit_log():
-    """Write the audit log to disk."""
-    fpath = os.path.join(app.output_dir, AUDIT_LOG_FNAME)
-    with open(fpath, "w") as fh:
-        app.tensor_manager.write_audit_log(fh)
+def dataset_route(rule, **options):
+    """Register a view of a dataset; the view is called with the dataset,
+    loaded and locked, as its first argument."""
+    def decorator(func):
+        @functools.wraps(func)
+        def view(name, **kwargs):
+            if name not in app.registry:
+                abort(404)
+            with app.registry.use(name) as dataset:
+                return func(dataset, **kwargs)
+        app.add_url_rule("/datasets/<name>" + rule, view_func=view, **options)
+        return func
+    return decorator
 
 
 @app.route("/")
-def index():
-    tensors = [tensor_manager[i] for i in app.tensor_manager.identifiers]
-    return render_template("template.html",
-                           xdim=app.xdim,
-                           ydim=app.ydim,
-                           tensors=tensors,
-                           cell_wall_image=app.wall_intensity,
-                           marker_image=app.marker_intensity,
-                           segmentation_image=app.segmentation)
+def datasets():
+    return render_template("datasets.html", datasets=app.registry.stats)
+
 
+@app.route("/stats")
+def stats():
+    """Return the load and eviction statistics of the datasets."""
+    return jsonify(max_loaded=app.registry.max_loaded,
+                   datasets=app.registry.stats)
 
-@app.route("/inactivate_tensor/<int:tensor_id>", methods=["POST"])
-def inactivate_tensor(tensor_id):
+
+@dataset_route("/")
+def index(dataset):
+    tensor_manager = dataset.tensor_manager
+    tensors = [tensor_manager[i] for i in tensor_manager.identifiers]
+    return render_template("template.html",
+                           xdim=dataset.xdim,
+                           ydim=dataset.ydim,
+                           tensors=tensors,
+                           version=tensor_manager.version,
+                           epoch=tensor_manager.epoch,
+                           tile_manifests=dataset.tile_manifests)
+
+
+@dataset_route("/tensors")
+def tensors(dataset):
+    """Return the tensors created or updated, and the identifiers of those
+    deleted, since the version given as ?since=N&epoch=E.
+
+    All the tensors are returned, with reset set, if the version is from
+    another epoch, as when the dataset has been reloaded."""
+    tensor_manager = dataset.tensor_manager
+    since = request.args.get("since", 0, type=int)
+    epoch = request.args.get("epoch", tensor_manager.epoch)
+    reset = epoch != tensor_manager.epoch or since > tensor_manager.version
+    if reset:
+        since = 0
+    tensor_ids, deleted = tensor_manager.changes_since(since)
+    header = json.dumps(dict(epoch=tensor_manager.epoch,
+                             version=tensor_manager.version,
+                             reset=reset,
+                             deleted=deleted))
+    # Join the json of the tensors rather than decoding and encoding it.
+    tensors = ", ".join(tensor_manager[i].json for i in tensor_ids)
+    body = '{}, "tensors": [{}]}}\n'.format(header[:-1], tensors)
+    return Response(body, mimetype="application/json")
+
+
+@dataset_route("/tiles/<layer>/<version>/<int:level>/<int:row>_<int:col>.png")
+def tile(dataset, layer, version, level, row, col):
+    if layer not in LAYERS:
+        abort(404)
+    if version != dataset.tile_manifests[layer]["version"]:
+        abort(404)
+    layer_dir = os.path.join(dataset.directory, TILES_DIRNAME, layer)
+    response = send_from_directory(layer_dir, tile_fname(level, row, col),
+                                   conditional=True)
+    response.cache_control.no_cache = None
+    response.cache_control.public = True
+    response.cache_control.max_age = TILE_MAX_AGE
+    return response
+
+
+@dataset_route("/images/<layer>.png")
+def image(dataset, layer):
+    """Return the full resolution image of a layer, for exporting."""
+    if layer not in LAYERS:
+        abort(404)
+    return send_from_directory(dataset.directory, layer + ".png",
+                               conditional=True)
+
+
+@dataset_route("/inactivate_tensor/<int:tensor_id>", methods=["POST"])
+def inactivate_tensor(dataset, tensor_id):
     if request.method == "POST":
-        info = app.tensor_manager.inactivate_tensor(tensor_id)
-        write_audit_log()
+        info = dataset.tensor_manager.inactivate_tensor(tensor_id)
         app.logger.debug("Inactivated tensor {:d}".format(tensor_id))
         app.logger.debug(info)
         return info
 
 
-@app.route("/update_marker/<int:tensor_id>/<float:y>/<float:x>", methods=["POST"])
-def update_marker(tensor_id, y, x):
+@dataset_route("/update_marker/<int:tensor_id>/<float:y>/<float:x>", methods=["POST"])
+def update_marker(dataset, tensor_id, y, x):
     if request.method == "POST":
-        info = app.tensor_manager.update_marker(tensor_id, (y, x))
-        write_audit_log()
+        info = dataset.tensor_manager.update_marker(tensor_id, (y, x))
         app.logger.debug("Updated marker: {}".format(info))
         return info
 
 
-@app.route("/update_centroid/<int:tensor_id>/<float:y>/<float:x>", methods=["POST"])
-def update_centroid(tensor_id, y, x):
+@dataset_route("/update_centroid/<int:tensor_id>/<float:y>/<float:x>", methods=["POST"])
+def update_centroid(dataset, tensor_id, y, x):
     if request.method == "POST":
-        info = app.tensor_manager.update_centroid(tensor_id, (y, x))
-        write_audit_log()
+        info = dataset.tensor_manager.update_centroid(tensor_id, (y, x))
         app.logger.debug("Update centroid: {}".format(info))
         return info
 
 
-@app.route("/add_tensor/<float:centroid_y>/<float:centroid_x>/<float:marker_y>/<float:marker_x>", methods=["POST"])
-def add_tensor(centroid_y, centroid_x, marker_y, marker_x):
+@dataset_route("/add_tensor/<float:centroid_y>/<float:centroid_x>/<float:marker_y>/<float:marker_x>", methods=["POST"])
+def add_tensor(dataset, centroid_y, centroid_x, marker_y, marker_x):
     if request.method == "POST":
-        info = app.tensor_manager.add_tensor((centroid_y, centroid_x),
+        info = dataset.tensor_manager.add_tensor((centroid_y, centroid_x),
                                                   (marker_y, marker_x))
-        write_audit_log()
         app.logger.debug("Add tensor: {}".format(info))
         return info
 
 
-@app.route("/undo", methods=["POST"])
-def undo():
+@dataset_route("/inactivate_tensors", methods=["POST"])
+def inactivate_tensors(dataset):
+    """Inactivate the tensors given as a JSON list of identifiers, or as
+    {"polygon": [[y, x], ...]} to inactivate those with their centroid
+    inside the polygon."""
+    data = request.get_json(force=True)
+    tensor_manager = dataset.tensor_manager
+    if not (isinstance(data, list)
+            or isinstance(data, dict) and "polygon" in data):
+        abort(400, "Expected a list of tensor identifiers or a polygon")
+    try:
+        if isinstance(data, dict):
+            tensor_ids = tensor_manager.tensors_in_polygon(data["polygon"],
+                                                           active_only=True)
+        else:
+            tensor_ids = data
+        info = tensor_manager.inactivate_many(tensor_ids)
+    except (KeyError, ValueError, TypeError) as e:
+        abort(400, "Invalid tensors: {}".format(e))
+    app.logger.debug("Inactivated {} tensors".format(len(tensor_ids)))
+    return "{}\n".format(info)
+
+
+@dataset_route("/apply_batch", methods=["POST"])
+def apply_batch(dataset):
+    """Apply a JSON list of updates, such as {"tensor_id": 3, "marker":
+    [y, x]}, as a single edit."""
+    try:
+        info = dataset.tensor_manager.apply_batch(request.get_json(force=True))
+    except (KeyError, ValueError, TypeError) as e:
+        abort(400, "Invalid batch: {}".format(e))
+    app.logger.debug("Applied batch: {}".format(info))
+    return "{}\n".format(info)
+
+
+@dataset_route("/undo", methods=["POST"])
+def undo(dataset):
     if request.method == "POST":
-        info =  "{}\n".format(app.tensor_manager.undo())
-        write_audit_log()
+        info =  "{}\n".format(dataset.tensor_manager.undo())
         return info
 
 
-@app.route("/redo", methods=["POST"])
-def redo():
+@dataset_route("/redo", methods=["POST"])
+def redo(dataset):
     if request.method == "POST":
-        info =  "{}\n".format(app.tensor_manager.redo())
-        write_audit_log()
+        info =  "{}\n".format(dataset.tensor_manager.redo())
         return info
 
 
-@app.route("/audit_log")
-def audit_log():
+@dataset_route("/audit_log")
+def audit_log(dataset):
     return render_template("audit_log.html",
-                           tensor_manager=app.tensor_manager)
+                           tensor_manager=dataset.tensor_manager)
 
 
-@app.route("/csv", methods=["GET", "POST"])
-def csv():
-    return "\n".join(app.tensor_manager.csv)
+@dataset_route("/csv", methods=["GET", "POST"])
+def csv(dataset):
+    columns = request.values.get("columns")
+    if columns:
+        columns = columns.split(",")
+    active_only = request.values.get("active_only", "") in ("1", "true")
+    try:
+        lines = dataset.tensor_manager.iter_csv(columns, active_only)
+    except ValueError as e:
+        abort(400, str(e))
+    # iter_csv copies the tensors while the dataset is locked; the lines are
+    # then formatted from the copy and streamed after the lock is released.
+    return Response(("{}\n".format(line) for line in lines),
+                    mimetype="text/csv")
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description=__doc__)
-    parser.add_argument("input_dir", help="input directory")
+    parser.add_argument("input_dirs", nargs="+",
+                        help="dataset directories, or directories containing "
+                             "them")
+    parser.add_argument("--max-loaded", type=int, default=4,
+                        help="number of datasets kept loaded at once; "
+                             "evicting a dataset drops its undo history")
+    parser.add_argument("--columnar", action="store_true",
+                        help="store the tensors in numpy arrays")
+    parser.add_argument("--coalesce-window", type=float, default=1.0,
+                        help="merge moves of the same point made within this "
+                             "many seconds of each other into one edit")
+    parser.add_argument("--max-history", type=int, default=None,
+                        help="number of edits that can be undone; older "
+                             "edits stay in the audit log")
+    parser.add_argument("--fsync-every", type=int, default=1,
+                        help="sync the audit journal to disk every N edits "
+                             "(0 leaves it to the operating system)")
     args = parser.parse_args()
 
-    if not os.path.isdir(args.input_dir):
-        parser.error("No such directory {}".format(args.input_dir))
-    app.output_dir = args.input_dir
-
-    for name in ["segmentation", "marker_intensity", "wall_intensity"]:
-        fname = name + ".png"
-        fpath = os.path.join(args.input_dir, fname)
-        if not os.path.isfile(fpath):
-            parser.error("No such file {}".format(fpath))
-        setattr(app, name, base64_from_fpath(fpath))
-
-    im_fpath = os.path.join(args.input_dir, fname)
-    im = PIL.Image.open(im_fpath)
-    xdim, ydim = im.size
-    app.xdim = xdim
-    app.ydim = ydim
-
-    tensor_manager = TensorManager()
-
-    fpath = os.path.join(args.input_dir, "raw_tensors.txt")
-    if not os.path.isfile(fpath):
-        parser.error("No such file {}".format(fpath))
-    with open(fpath) as fh:
-        tensor_manager.read_raw_tensors(fh)
-
-    fpath = os.path.join(args.input_dir, AUDIT_LOG_FNAME)
-    if os.path.isfile(fpath):
-        with open(fpath) as fh:
-            tensor_manager.apply_audit_log(fh)
-
-    app.tensor_manager = tensor_manager
-
-    app.run("0.0.0.0", debug=True)
+    for input_dir in args.input_dirs:
+        if not os.path.isdir(input_dir):
+            parser.error("No such directory {}".format(input_dir))
+    if args.max_loaded < 1:
+        parser.error("--max-loaded must be at least 1")
+
+    if args.columnar:
+        manager_class = ColumnarTensorManager
+    else:
+        manager_class = TensorManager
+    # Datasets are loaded on first access, folding the edits of their
+    # previous session into the audit log.
+    app.registry = DatasetRegistry(
+        args.input_dirs,
+        max_loaded=args.max_loaded,
+        manager_class=manager_class,
+        manager_kwargs=dict(coalesce_window=args.coalesce_window,
+                            max_history=args.max_history),
+        fsync_every=args.fsync_every)
+    if len(app.registry) == 0:
+        parser.error("No datasets found in {}".format(
+            ", ".join(args.input_dirs)))
+
+    try:
+        app.run("0.0.0.0", debug=True)
+    finally:
+        app.registry.close()